@@ -0,0 +1,222 @@
+###############################################################################
+###############################################################################
+##
+##  SENDXLSRESULTS - cell type classification shared by the sendxlsresults
+##  command and the sendxlsresults_alert action
+##
+##  Every result value arrives as a string. classify() decides in a single
+##  pass whether it is a date, a number or plain text and returns the value
+##  to write along with the number format to use.
+##
+###############################################################################
+###############################################################################
+import re
+
+STRING = 0
+DATE = 1
+NUMBER = 2
+
+FORMAT_STRING = ''
+FORMAT_DATE = 'M/D/YY'
+FORMAT_INT = '0'
+FORMAT_FLOAT = '0.00'
+FORMAT_INT_THOUSANDS = '#,##0'
+FORMAT_FLOAT_THOUSANDS = '#,##0.00'
+FORMAT_EXPONENT = '0.00E+00'
+
+# every number format classify() can return
+NUM_FORMATS = (FORMAT_STRING, FORMAT_DATE, FORMAT_INT, FORMAT_FLOAT,
+               FORMAT_INT_THOUSANDS, FORMAT_FLOAT_THOUSANDS, FORMAT_EXPONENT)
+
+# Dates only have to match at the start (so "2020-02-13 10:00:00" is a date),
+# numbers have to match the whole value. Dates are tried first, "1.2.3" is
+# a date (or a version number), not a number.
+_cell_re = re.compile(r'''
+      (?P<date>\d+-\d+-\d+|\d+/\d+/\d+|\d+\.\d+\.\d+)
+    | (?P<number>
+          [-+]?
+          (?:\d{1,3}(?P<thousands>(?:,\d{3})+)|\d+)
+          (?P<fraction>\.\d+)?
+          (?P<exponent>[eE][-+]?\d+)?
+      $)
+''', re.VERBOSE)
+
+# a value can only be a date or a number if it starts with one of these,
+# everything else is text without running the regex
+_first_chars = frozenset('0123456789-+')
+_digits = frozenset('0123456789')
+_number_chars = frozenset('0123456789-+.eE')
+
+# share of distinct values from which a text column is considered unique
+UNIQUE_TEXT_RATIO = 0.98
+# fewer sampled text values than this say nothing about a column
+UNIQUE_TEXT_MIN_SAMPLE = 10
+
+###############################################################################
+#
+# Function:   classify
+#
+# Descrition: Classifies a single result value.
+#
+# Arguments:
+#    s - the value as string.
+#
+# Returns:    (cell type, value to write, number format) where the value is a
+#             float for NUMBER and the unchanged string for DATE and STRING.
+#
+###############################################################################
+
+def classify(s):
+    if s[:1] not in _first_chars:
+        return STRING, s, FORMAT_STRING
+    m = _cell_re.match(s)
+    if m is None:
+        return STRING, s, FORMAT_STRING
+    if m.lastgroup == 'date':
+        return DATE, s, FORMAT_DATE
+    if m.group('exponent'):
+        num_format = FORMAT_EXPONENT
+    elif m.group('thousands'):
+        num_format = m.group('fraction') and FORMAT_FLOAT_THOUSANDS or FORMAT_INT_THOUSANDS
+    else:
+        num_format = m.group('fraction') and FORMAT_FLOAT or FORMAT_INT
+    value = float(m.group('thousands') and s.replace(',', '') or s)
+    if value - value != 0: # "1e999" overflows to inf
+        return STRING, s, FORMAT_STRING
+    return NUMBER, value, num_format
+
+###############################################################################
+#
+# Function:   infer_column_types
+#
+# Descrition: Picks one cell type and number format per column from a sample
+#             of rows. A column is a NUMBER or DATE column if every non-empty
+#             sampled value is of that type, otherwise it is a STRING column.
+#             Columns without any sampled value get None (classified per cell).
+#             Mixed integer/decimal columns get the decimal format.
+#
+# Arguments:
+#    sample_rows - list of rows, each a list of string values.
+#    ncols       - number of columns.
+#
+# Returns:    list of (cell type, number format) or None, one per column.
+#
+###############################################################################
+
+def infer_column_types(sample_rows, ncols):
+    schema = []
+    for colx in range(ncols):
+        celltypes = set()
+        num_formats = set()
+        for row in sample_rows:
+            if colx >= len(row) or row[colx] == '':
+                continue
+            celltype, value, num_format = classify(row[colx])
+            celltypes.add(celltype)
+            num_formats.add(num_format)
+        if not celltypes:
+            schema.append(None)
+        elif celltypes == set([NUMBER]):
+            if len(num_formats) == 1:
+                num_format = num_formats.pop()
+            elif FORMAT_EXPONENT in num_formats:
+                num_format = FORMAT_EXPONENT
+            elif num_formats & set([FORMAT_INT_THOUSANDS, FORMAT_FLOAT_THOUSANDS]):
+                num_format = FORMAT_FLOAT_THOUSANDS
+            else:
+                num_format = FORMAT_FLOAT
+            schema.append((NUMBER, num_format))
+        elif celltypes == set([DATE]):
+            schema.append((DATE, FORMAT_DATE))
+        else:
+            schema.append((STRING, FORMAT_STRING))
+    return schema
+
+###############################################################################
+#
+# Function:   column_converters
+#
+# Descrition: Turns a schema from infer_column_types() into one converter per
+#             column. A converter takes a value and returns the same tuple as
+#             classify(). STRING columns return the value as is, NUMBER
+#             columns try int()/float() with the column's number format and
+#             only fall back to classify() for values that don't convert.
+#
+###############################################################################
+
+def _string_converter(s):
+    return STRING, s, FORMAT_STRING
+
+# int() and float() also take values classify() treats as text, like " 7 ",
+# "-.5", "5.", "1.e5" or (on Python 3) "1_000", those are left to classify()
+def _plain_number(s):
+    first = s[1:2] if s[:1] in ('-', '+') else s[:1]
+    return (first in _digits and s[-1:] in _digits and _number_chars.issuperset(s)
+            and '.e' not in s and '.E' not in s)
+
+def _int_converter(num_format):
+    def convert(s):
+        if not _plain_number(s):
+            return classify(s)
+        try:
+            return NUMBER, float(int(s)), num_format
+        except ValueError:
+            return classify(s)
+    return convert
+
+def _float_converter(num_format):
+    def convert(s):
+        if not _plain_number(s):
+            return classify(s)
+        try:
+            value = float(s)
+        except ValueError:
+            return classify(s)
+        if value - value != 0: # float() also takes "nan" and "inf"
+            return classify(s)
+        return NUMBER, value, num_format
+    return convert
+
+def column_converters(schema):
+    converters = []
+    for column_type in schema:
+        if column_type is None:
+            converters.append(classify)
+            continue
+        celltype, num_format = column_type
+        if celltype == STRING:
+            converters.append(_string_converter)
+        elif celltype == NUMBER and num_format in (FORMAT_INT, FORMAT_INT_THOUSANDS):
+            converters.append(_int_converter(num_format))
+        elif celltype == NUMBER:
+            converters.append(_float_converter(num_format))
+        else:
+            converters.append(classify)
+    return converters
+
+###############################################################################
+#
+# Function:   unique_text_columns
+#
+# Descrition: Picks the columns whose sampled text values are (nearly) all
+#             different, like _raw, URLs or session ids. Sharing their values
+#             through the xls shared string table costs memory and time
+#             without saving anything, so they are written inline instead.
+#
+# Arguments:
+#    sample_rows - list of rows, each a list of string values.
+#    ncols       - number of columns.
+#    min_ratio   - share of distinct values a column needs.
+#
+# Returns:    list of column indexes.
+#
+###############################################################################
+
+def unique_text_columns(sample_rows, ncols, min_ratio=UNIQUE_TEXT_RATIO):
+    columns = []
+    for colx in range(ncols):
+        texts = [row[colx] for row in sample_rows
+                 if colx < len(row) and row[colx] != '' and classify(row[colx])[0] == STRING]
+        if len(texts) >= UNIQUE_TEXT_MIN_SAMPLE and len(set(texts)) >= min_ratio * len(texts):
+            columns.append(colx)
+    return columns
@@ -0,0 +1,134 @@
+###############################################################################
+###############################################################################
+##
+##  SENDXLSRESULTS - on-disk cache of the email alert action settings shared
+##  by the sendxlsresults command and the sendxlsresults_alert action
+##
+##  Every run needs the mail server, sender, SSL/TLS flags and report file
+##  name from alert_actions.conf, which costs a round trip to splunkd. The
+##  values are kept in a JSON file under $SPLUNK_HOME/var/run/splunk, per
+##  server URI and namespace, for a number of seconds. An entry is dropped
+##  early when any alert_actions.conf changed since it was written.
+##
+###############################################################################
+###############################################################################
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+CACHE_FILE = 'sendxlsresults_email_conf.json'
+
+# seconds the settings are used without asking splunkd, 0 disables the cache
+CACHE_TTL = 300
+
+# the files the email settings come from, relative to $SPLUNK_HOME
+CONF_FILES = (
+    os.path.join('etc', 'system', '*', 'alert_actions.conf'),
+    os.path.join('etc', 'apps', '*', '*', 'alert_actions.conf'),
+)
+
+def _splunk_home():
+    return os.environ['SPLUNK_HOME']
+
+def _cache_path():
+    return os.path.join(_splunk_home(), 'var', 'run', 'splunk', CACHE_FILE)
+
+###############################################################################
+#
+# Function:   conf_checksum
+#
+# Descrition: Checksum over the names, sizes and modification times of all
+#             alert_actions.conf files. Saving the email settings, in Splunk
+#             Web or by editing a file, changes it. Only stats the files.
+#
+###############################################################################
+
+def conf_checksum():
+    digest = hashlib.md5()
+    home = _splunk_home()
+    for pattern in CONF_FILES:
+        for path in sorted(glob.glob(os.path.join(home, pattern))):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            digest.update(('%s %d %d\n' % (path, st.st_size, st.st_mtime)).encode('utf-8'))
+    return digest.hexdigest()
+
+def _key(server_uri, namespace):
+    return '%s %s' % (server_uri, namespace or '-')
+
+def _read():
+    try:
+        with open(_cache_path()) as f:
+            entries = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    return entries if isinstance(entries, dict) else {}
+
+###############################################################################
+#
+# Function:   load
+#
+# Descrition: Returns the cached settings for a server and namespace, or None
+#             if there are none, they are older than ttl seconds or an
+#             alert_actions.conf changed since they were stored.
+#
+# Arguments:
+#    server_uri - splunkd URI the settings were read from.
+#    namespace  - app namespace of the lookup, None for the global one.
+#    ttl        - maximum age in seconds, 0 always returns None.
+#
+###############################################################################
+
+def load(server_uri, namespace, ttl=CACHE_TTL):
+    if ttl <= 0:
+        return None
+    entry = _read().get(_key(server_uri, namespace))
+    if not isinstance(entry, dict):
+        return None
+    if not 0 <= time.time() - entry.get('time', 0) <= ttl:
+        return None
+    if entry.get('checksum') != conf_checksum():
+        return None
+    return entry.get('values')
+
+###############################################################################
+#
+# Function:   store
+#
+# Descrition: Stores the settings for a server and namespace. The file is
+#             replaced atomically, so runs started at the same time never
+#             read half a file; expired entries of other keys are dropped.
+#             Failing to write the cache is not an error.
+#
+# Arguments:
+#    server_uri - splunkd URI the settings were read from.
+#    namespace  - app namespace of the lookup, None for the global one.
+#    values     - dict of settings, must not contain passwords.
+#    ttl        - maximum age in seconds, 0 stores nothing.
+#
+###############################################################################
+
+def store(server_uri, namespace, values, ttl=CACHE_TTL):
+    if ttl <= 0:
+        return
+    now = time.time()
+    entries = dict((key, entry) for key, entry in _read().items()
+                   if isinstance(entry, dict) and now - entry.get('time', 0) <= ttl)
+    entries[_key(server_uri, namespace)] = {'time': now, 'checksum': conf_checksum(), 'values': values}
+    path = _cache_path()
+    try:
+        fd, tmp = tempfile.mkstemp(prefix=CACHE_FILE + '.', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+    except (IOError, OSError):
+        pass
@@ -0,0 +1,315 @@
+###############################################################################
+###############################################################################
+##
+##  SENDXLSRESULTS - streaming mail sending shared by the sendxlsresults
+##  command and the sendxlsresults_alert action
+##
+##  The attachment is never read into memory as a whole. It is base64
+##  encoded in chunks straight from disk while smtplib is in its DATA
+##  phase, so memory use does not depend on the size of the attachment.
+##
+###############################################################################
+###############################################################################
+import base64
+import copy
+import logging as logger
+import os
+import smtplib
+import socket
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+from email.mime.base import MIMEBase
+
+# bytes of the attachment encoded at a time, a multiple of 57 so every
+# chunk is whole 76 character base64 lines
+BASE64_CHUNK_SIZE = 57 * 4096
+
+# base64.encodestring() is called encodebytes() on Python 3
+_encodebytes = getattr(base64, 'encodebytes', None) or base64.encodestring
+
+CRLF = '\r\n'
+
+# delivery settings: one message to all recipients, a copy per recipient,
+# a copy per recipient domain
+DELIVERIES = ('all', 'recipient', 'domain')
+
+# copies sent at the same time, each over its own SMTP connection
+SEND_WORKERS = 4
+
+# times a copy is sent again after a temporary (4xx or connection) failure,
+# waiting RETRY_BACKOFF seconds before the first retry and twice as long
+# before every further one
+SEND_RETRIES = 2
+RETRY_BACKOFF = 1.0
+
+# MIME type of attachments by file extension, everything else is sent as
+# application/octet-stream
+ATTACHMENT_TYPES = {
+    '.zip': ('application', 'zip'),
+}
+
+###############################################################################
+#
+# Class:      AttachmentMessage
+#
+# Descrition: A multipart message with a file attachment that is encoded
+#             while the message is sent. The headers and all other parts are
+#             formatted by the email package as usual, with a marker in place
+#             of the attachment's payload; the message is sent as the text
+#             before the marker, the encoded file and the text after it.
+#
+# Arguments:
+#    msg             - MIMEMultipart with the headers and the other parts.
+#    attachment_file - the attachment, a file opened in binary mode.
+#    filename        - name of the attachment in the message, its extension
+#                      picks the MIME type (see ATTACHMENT_TYPES).
+#
+###############################################################################
+
+class AttachmentMessage(object):
+
+    def __init__(self, msg, attachment_file, filename):
+        self.attachment_file = attachment_file
+        maintype, subtype = ATTACHMENT_TYPES.get(os.path.splitext(filename)[1].lower(),
+                                                 ('application', 'octet-stream'))
+        part = MIMEBase(maintype, subtype)
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header('Content-Disposition', 'attachment; filename="' + filename + '"')
+        marker = 'attachment-%s' % uuid.uuid4().hex
+        part.set_payload(marker)
+        msg.attach(part)
+        # the text around the attachment as sent: CRLF line ends and dot
+        # stuffed, base64 lines never start with a dot
+        head, tail = msg.as_string().split(marker)
+        self.head = smtplib.quotedata(head)
+        self.tail = smtplib.quotedata(tail)
+        if not self.tail.endswith(CRLF):
+            self.tail += CRLF
+
+    def attachment_size(self):
+        return os.fstat(self.attachment_file.fileno()).st_size
+
+    def copy(self, attachment_file):
+        # the same message reading the attachment through another file, so
+        # copies can be sent from several threads at once
+        message = copy.copy(self)
+        message.attachment_file = attachment_file
+        return message
+
+    def size(self):
+        # length of the message as sent, for the SIZE extension
+        lines, rest = divmod(self.attachment_size(), 57)
+        encoded = lines * 78
+        if rest:
+            encoded += (rest + 2) // 3 * 4 + 2
+        if encoded:
+            encoded -= 2
+        return len(self.head) + encoded + len(self.tail)
+
+    def chunks(self):
+        # the message as sent in the DATA phase
+        yield self.head
+        self.attachment_file.seek(0)
+        encoded = None
+        while True:
+            data = self.attachment_file.read(BASE64_CHUNK_SIZE)
+            if not data:
+                break
+            if encoded is not None:
+                yield encoded
+            encoded = _encodebytes(data).replace(b'\n', b'\r\n')
+        if encoded is not None:
+            # like email.encoders, no line end after the last line, the
+            # boundary that follows starts with one
+            yield encoded[:-2]
+        yield self.tail
+
+###############################################################################
+#
+# Function:   send_message
+#
+# Descrition: Same as smtp.sendmail(sender, recipients, message) for an
+#             AttachmentMessage: the message is streamed to the server
+#             chunk by chunk instead of being passed as one string.
+#
+# Returns:    dict of refused recipients like smtplib.SMTP.sendmail(),
+#             raises the same exceptions.
+#
+###############################################################################
+
+def send_message(smtp, sender, recipients, message):
+    smtp.ehlo_or_helo_if_needed()
+    esmtp_opts = []
+    if smtp.does_esmtp and smtp.has_extn('size'):
+        esmtp_opts.append('size=%d' % message.size())
+    code, resp = smtp.mail(sender, esmtp_opts)
+    if code != 250:
+        smtp.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, sender)
+    refused = {}
+    for recipient in recipients:
+        code, resp = smtp.rcpt(recipient)
+        if code not in (250, 251):
+            refused[recipient] = (code, resp)
+    if len(refused) == len(recipients):
+        smtp.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    smtp.putcmd('data')
+    code, resp = smtp.getreply()
+    if code != 354:
+        smtp.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    for chunk in message.chunks():
+        smtp.send(chunk)
+    smtp.send('.' + CRLF)
+    code, resp = smtp.getreply()
+    if code != 250:
+        smtp.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+###############################################################################
+#
+# Function:   recipient_groups
+#
+# Descrition: Splits the recipients into the groups that get a copy of the
+#             message each, see DELIVERIES.
+#
+# Arguments:
+#    recipients - list of addresses.
+#    delivery   - "all", "recipient" or "domain".
+#
+# Returns:    list of lists of addresses, in the order of the recipients.
+#
+###############################################################################
+
+def recipient_groups(recipients, delivery):
+    if delivery not in DELIVERIES:
+        raise ValueError("unsupported delivery %r, expected one of %s" % (delivery, ", ".join(DELIVERIES)))
+    recipients = [r.strip() for r in recipients if r.strip()]
+    if delivery == 'all':
+        return [recipients]
+    if delivery == 'recipient':
+        return [[r] for r in recipients]
+    groups = []
+    by_domain = {}
+    for r in recipients:
+        domain = r.rpartition('@')[2].lower()
+        if domain not in by_domain:
+            by_domain[domain] = []
+            groups.append(by_domain[domain])
+        by_domain[domain].append(r)
+    return groups
+
+###############################################################################
+#
+# Function:   send_copies
+#
+# Descrition: Sends a copy of the message to each group of recipients through
+#             a bounded pool of threads, each with its own connection from
+#             the SMTP pool. A copy that fails temporarily (connection lost,
+#             4xx replies) is sent again with exponential backoff, recipients
+#             refused temporarily are retried on their own. A failing group
+#             does not keep the others from getting their copy.
+#
+# Arguments:
+#    smtp_pool       - smtppool.SMTPPool of the mail server.
+#    sender          - envelope sender.
+#    groups          - list of lists of recipients, see recipient_groups().
+#    message         - the AttachmentMessage.
+#    attachment_path - the attachment's file, opened once per copy.
+#    workers         - copies sent at the same time.
+#    retries         - times a copy is retried.
+#    backoff         - seconds before the first retry.
+#
+# Returns:    dict of recipient to (status, attempts, detail) with status
+#             "sent", "refused" or "failed".
+#
+###############################################################################
+
+def _temporary(e):
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    # socket errors and lost connections, on Python 3 SMTPException is one
+    # of the socket errors itself
+    return isinstance(e, smtplib.SMTPServerDisconnected) or not isinstance(e, smtplib.SMTPException)
+
+def _send_copy(smtp_pool, sender, recipients, message, attachment_path, retries, backoff):
+    results = {}
+    pending = recipients
+    for attempt in range(1, retries + 2):
+        if attempt > 1:
+            time.sleep(backoff * 2 ** (attempt - 2))
+        try:
+            with open(attachment_path, 'rb') as attachment_file:
+                with smtp_pool.connection() as smtp:
+                    refused = send_message(smtp, sender, pending, message.copy(attachment_file))
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+        except (socket.error, smtplib.SMTPException) as e:
+            if attempt <= retries and _temporary(e):
+                continue
+            for r in pending:
+                results[r] = ('failed', attempt, str(e))
+            return results
+        retry = []
+        for r in pending:
+            if r not in refused:
+                results[r] = ('sent', attempt, '')
+            elif attempt <= retries and 400 <= refused[r][0] < 500:
+                retry.append(r)
+            else:
+                results[r] = ('refused', attempt, '%s %s' % refused[r])
+        pending = retry
+        if not pending:
+            break
+    return results
+
+def send_copies(smtp_pool, sender, groups, message, attachment_path,
+                workers=SEND_WORKERS, retries=SEND_RETRIES, backoff=RETRY_BACKOFF):
+    results = {}
+    if not groups:
+        return results
+    threads = ThreadPool(max(1, min(workers, len(groups))))
+    try:
+        for group_results in threads.map(
+                lambda group: _send_copy(smtp_pool, sender, group, message, attachment_path, retries, backoff),
+                groups, 1):
+            results.update(group_results)
+    finally:
+        threads.close()
+        threads.join()
+    return results
+
+###############################################################################
+#
+# Function:   report_copies
+#
+# Descrition: Logs the outcome of send_copies(): an error per recipient that
+#             did not get the message and a summary line. Raises
+#             SMTPRecipientsRefused if no recipient got it, a run where only
+#             some copies failed succeeds.
+#
+# Arguments:
+#    results         - the result of send_copies().
+#    delivery        - "recipient" or "domain", see DELIVERIES.
+#    ncopies         - copies sent, the number of recipient groups.
+#    invocation_id   - id of the run, for the log lines.
+#    invocation_type - "command" or "action", for the log lines.
+#
+# Returns:    dict of recipient to (status, detail) for the recipients that
+#             did not get the message.
+#
+###############################################################################
+
+def report_copies(results, delivery, ncopies, invocation_id, invocation_type):
+    failed = {}
+    for rcpt, (status, attempts, detail) in sorted(results.items()):
+        if status != "sent":
+            failed[rcpt] = (status, detail)
+            logger.error('invocation_id=%s invocation_type="%s" msg="Could not send email" rcpt="%s" status="%s" attempts=%d error="%s"' % (invocation_id,invocation_type,rcpt,status,attempts,detail))
+    logger.info('invocation_id=%s invocation_type="%s" msg="email sent per %s" copies=%d sent=%d failed=%d' % (invocation_id,invocation_type,delivery,ncopies,len(results)-len(failed),len(failed)))
+    if results and len(failed) == len(results):
+        raise smtplib.SMTPRecipientsRefused(failed)
+    return failed
@@ -18,14 +18,17 @@ import splunk.entity as entity
 import smtplib, email
 from email.MIMEMultipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.MIMEBase import MIMEBase
-from email import Encoders
+import mailstream
+import smtppool
+import confcache
 import logging as logger
 
 import csv
 import re
 import xlwt
 import copy
+from xlsresults import SheetRoller, new_workbook, add_format_styles, save_workbook, MAX_ROWS
+from celltypes import classify, unique_text_columns
 from splunk.util import normalizeBoolean
 
 
@@ -38,6 +41,9 @@ SALT            = random.randint(0, 100000)
 INVOCATION_ID   = str(NOWTIME) + ':' + str(SALT)
 INVOCATION_TYPE = "command"
 
+# results looked at to find text columns without repeated values
+INLINE_SAMPLE_ROWS = 100
+
 ###############################################################################
 #
 # Function:   getEmailAlertActions
@@ -50,11 +56,24 @@ INVOCATION_TYPE = "command"
 #    argvals  - hash of various arguments passed into the search.
 #    settings - hash of various Splunk configuration settings.
 #
+#             The settings are cached for email_config_ttl seconds, see
+#             confcache. Settings with SMTP credentials are never cached, the
+#             password is not written to disk.
+#
 ###############################################################################
 
+# settings read from the email alert action, without the credentials
+EMAIL_SETTINGS = ('server', 'sender', 'use_ssl', 'use_tls')
+
 def getEmailAlertActions(argvals, settings):
+    ttl        = int(getarg(argvals, "email_config_ttl", str(confcache.CACHE_TTL)) or 0)
+    server_uri = splunk.getLocalServerInfo()
+    namespace  = settings.get("namespace", None)
+    cached = confcache.load(server_uri, namespace, ttl)
+    if cached is not None:
+        argvals.update(cached)
+        return
     try:
-        namespace  = settings.get("namespace", None)
         sessionKey = settings['sessionKey']
         ent = entity.getEntity('admin/alert_actions', 'email', namespace=namespace, owner='nobody', sessionKey=sessionKey)
         print("entity:", file=sys.stderr)
@@ -64,9 +83,11 @@ def getEmailAlertActions(argvals, settings):
         argvals['sender'] = ent['from']
         argvals['use_ssl'] = ent['use_ssl']
         argvals['use_tls'] = ent['use_tls']
-        if 'auth_username' in ent and 'clear_password' in ent:
+        if ent.get('auth_username') and ent.get('clear_password'):
             argvals['username'] = ent['auth_username']
             argvals['password'] = ent['clear_password']
+        else:
+            confcache.store(server_uri, namespace, dict((key, argvals[key]) for key in EMAIL_SETTINGS), ttl)
     except Exception as e:
         logger.error('invocation_id=%s invocation_type="%s" msg="Could not get email alert actions from splunk" error="%s"' % (INVOCATION_ID,INVOCATION_TYPE,str(e)))
         raise
@@ -96,6 +117,10 @@ def sendemail(recipient, sender, subject, body, argvals, attachment):
     use_tls   = toBool(argvals['use_tls'])
     username  = getarg(argvals, "username"  , "")
     password  = getarg(argvals, "password"  , "")
+    idle_timeout = int(getarg(argvals, "smtp_idle_timeout", str(smtppool.IDLE_TIMEOUT)) or 0)
+    delivery     = (getarg(argvals, "delivery", "all") or "all").lower()
+    send_workers = int(getarg(argvals, "send_workers", str(mailstream.SEND_WORKERS)) or 1)
+    send_retries = int(getarg(argvals, "send_retries", str(mailstream.SEND_RETRIES)) or 0)
     recipient = getarg(argvals, "recipient" , "")
 
     # make sure the sender is a valid email address
@@ -114,40 +139,36 @@ def sendemail(recipient, sender, subject, body, argvals, attachment):
     msg.attach(part1)
 
     try:
-        part2 = MIMEBase('application', "octet-stream")
-        part2.set_payload(open(os.environ['SPLUNK_HOME'] + "/var/run/splunk/" + attachment, "rb").read())
-        Encoders.encode_base64(part2)
-        part2.add_header('Content-Disposition', 'attachment; filename="' + attachment + '"')
-        msg.attach(part2)
+        # the attachment is encoded while it is sent, see mailstream
+        attachment_path = os.environ['SPLUNK_HOME'] + "/var/run/splunk/" + attachment
+        attachment_file = open(attachment_path, "rb")
+        message = mailstream.AttachmentMessage(msg, attachment_file, attachment)
     except Exception as e:
         print("exception while attaching file occured", file=sys.stderr)
         logger.error('invocation_id=%s invocation_type="%s" msg="error attaching file" rcpt="%s" error="%s"' % (INVOCATION_ID,INVOCATION_TYPE,recipient,str(e)))
         raise        
     try:
-        # send the mail
-        if not use_ssl:
-            print("plain jane mail", file=sys.stderr)
-            smtp = smtplib.SMTP(server)
+        # send the mail over a pooled connection, see smtppool
+        pool = smtppool.get_pool(server, use_ssl, use_tls, username, password, idle_timeout)
+        if delivery == "all":
+            with pool.connection() as smtp:
+                print("go go gadget - send email!", file=sys.stderr)
+                print(mailstream.send_message(smtp, sender, string.split(recipient, ","), message), file=sys.stderr)
         else:
-            print >> sys.stderr, "use ssl mail"
-            smtp = smtplib.SMTP_SSL(server)
-
-        if use_tls:
-            print("use TLS", file=sys.stderr)
-            smtp.ehlo()
-            smtp.starttls()
-        if len(username) > 0 and len(password) >0:
-            print("user username/password", file=sys.stderr)
-            smtp.login(username, password)
-
-        print("go go gadget - send email!", file=sys.stderr)
-        print(smtp.sendmail(sender, string.split(recipient, ","), msg.as_string()), file=sys.stderr)
-        smtp.quit()
+            # a copy per recipient or recipient domain, a bad address only fails its own copy
+            print("go go gadget - send email per %s!" % delivery, file=sys.stderr)
+            groups = mailstream.recipient_groups(string.split(recipient, ","), delivery)
+            results = mailstream.send_copies(pool, sender, groups, message, attachment_path, send_workers, send_retries)
+            failed = mailstream.report_copies(results, delivery, len(groups), INVOCATION_ID, INVOCATION_TYPE)
+            print(failed, file=sys.stderr)
+        print("smtp connections opened %d reused %d" % (pool.connects, pool.reuses), file=sys.stderr)
         return
     except Exception as e:
         print("exception while sending email occured", file=sys.stderr)
         logger.error('invocation_id=%s invocation_type="%s" msg="Could not send email" rcpt="%s" error="%s"' % (INVOCATION_ID,INVOCATION_TYPE,recipient,str(e)))
         raise
+    finally:
+        attachment_file.close()
 
 
 ######################################################
@@ -175,51 +196,35 @@ def getarg(argvals, name, defaultVal=None):
 ######################################################
 # converto to workbook to attach later
 
-def csv_to_xls(search_name, output=None):
+def csv_to_xls(search_name, output=None, row_batch_size=0, output_format="xls", sst_memory_mb=0, compression="none", compress_threshold=0):
     if output is None:
         output = sys.stdout
-    logger.info("parameters used: outputfile %s" % (output))
-    int_re = re.compile(r'^\d+$')
-    float_re = re.compile(r'^\d+\.\d+$')
-    date_re = re.compile(r'^\d+-\d+-\d+|^\d+\/\d+\/\d+|^\d+\.\d+\.\d+')
-    style = xlwt.XFStyle()
-
-    workbook = xlwt.Workbook(encoding="UTF-8") #()
-    sheet = workbook.add_sheet(search_name)
-
-    #headers...
-    columns = results[0]
-    column_num = 0
-    for key in list(results[0].keys()):
-        if not key.startswith('__'): # skip stuff like __mv
-            sheet.write(0, column_num, key)
-            column_num += 1
-            
-    row_num = 0
+    logger.info("parameters used: outputfile %s format %s row_batch_size %s sst_memory_mb %s" % (output, output_format, row_batch_size, sst_memory_mb))
+    workbook = new_workbook(output_format, output, sst_memory_mb * 1024 * 1024)
+    xf_indexes = add_format_styles(workbook)
+
+    #headers... skip stuff like __mv
+    columns = []
+    if len(results) > 0:
+        columns = [key for key in list(results[0].keys()) if not key.startswith('__')]
+    # text columns without repeated values in the first rows skip the shared string table
+    inline_cols = []
+    if output_format == 'xls':
+        inline_cols = unique_text_columns([[row.get(key, "") for key in columns] for row in results[:INLINE_SAMPLE_ROWS]], len(columns))
+    # new sheets are added once one is full, the header is repeated on each of them
+    sheets = SheetRoller(workbook, search_name, columns, row_batch_size, MAX_ROWS[output_format], inline_cols)
+
     for row in results:
-        column_num = 0
-        for item in row:
-            format = 'general'
-            cellvalue = ""
-            if re.match(date_re, row[item]):
-                cellvalue = row[item]
-                format = 'M/D/YY'
-            elif re.match(float_re, row[item]):
-                cellvalue = float(row[item])
-                format = '0.00'
-            elif re.match(int_re, row[item]):
-                cellvalue = float(row[item])
-                format = '0'
-            else:
-                cellvalue = row[item]
-                format = ''
-            style.num_format_str = format
-            sheet.write(row_num +1, column_num, cellvalue, style) #sheet.write(row_num, column_num, unicode(item).encode("utf-8"), style)
-            column_num += 1
-        row_num += 1
+        values = []
+        formats = []
+        for key in columns:
+            celltype, cellvalue, format = classify(row.get(key, ""))
+            values.append(cellvalue)
+            formats.append(xf_indexes[format])
+        sheets.write_row(values, formats)
  
-    workbook.save(output)
-    return True
+    # returns the file to attach, output.zip if it got zipped
+    return save_workbook(workbook, output, output_format, compression, compress_threshold)
 
 
     
@@ -245,6 +250,11 @@ recipient          = getarg(argvals, "recipient", "")
 filename           = getarg(argvals, "filename", "")
 search_name        = getarg(argvals, "search_name", "one")
 smptHost           = getarg(argvals, "server", "localhost")
+row_batch_size     = int(getarg(argvals, "row_batch_size", "1000") or 0)
+output_format      = (getarg(argvals, "format", "xls") or "xls").lower()
+sst_memory_mb      = int(getarg(argvals, "sst_memory_mb", "64") or 0)
+compression        = (getarg(argvals, "attachment_compression", "auto") or "auto").lower()
+compress_threshold = int(getarg(argvals, "compress_threshold_mb", "10") or 0)
 
 results = []
 
@@ -257,7 +267,9 @@ try:
     print(smptHost, file=sys.stderr)
     
     try:
-        csv_to_xls(search_name, os.environ['SPLUNK_HOME'] + "/var/run/splunk/" + filename)
+        attachment = csv_to_xls(search_name, os.environ['SPLUNK_HOME'] + "/var/run/splunk/" + filename, row_batch_size, output_format, sst_memory_mb,
+                                compression, compress_threshold * 1024 * 1024)
+        filename = os.path.basename(attachment)
         sendemail(recipient, sender, subject, bodyText, argvals, filename)
 
     except Exception as e:
@@ -19,11 +19,13 @@ import gzip
 import smtplib, email
 from email.MIMEMultipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.MIMEBase import MIMEBase
-from email import Encoders
+import mailstream
+import smtppool
+import confcache
 
 import socket
 import string
+import itertools
 import random
 import time
 from collections import defaultdict
@@ -32,6 +34,8 @@ import logging as logger
 import re
 import xlwt
 import copy
+from xlsresults import SheetRoller, new_workbook, add_format_styles, save_workbook, MAX_ROWS
+from celltypes import classify, infer_column_types, column_converters, unique_text_columns
 from splunk.util import normalizeBoolean
 
 #might fix the error - see https://stackoverflow.com/questions/11536764/how-to-fix-attempted-relative-import-in-non-package-even-with-init-py
@@ -91,9 +95,20 @@ def request(method, url, data, headers):
 #    argvals  - hash of various arguments passed into the search.
 #    payload  - hash of various Splunk configuration settings.
 #
+#             The settings are cached for email_config_ttl seconds, see
+#             confcache.
+#
 ###############################################################################
 
+# settings read from the email alert action
+EMAIL_SETTINGS = ('server', 'sender', 'use_ssl', 'use_tls', 'reportFileName')
+
 def getEmailAlertActions(argvals, payload):
+    ttl = int(getarg(payload.get('configuration') or {}, "email_config_ttl", str(confcache.CACHE_TTL)) or 0)
+    cached = confcache.load(payload.get('server_uri'), None, ttl)
+    if cached is not None:
+        argvals.update(cached)
+        return
     try:
         url_tmpl = '%(server_uri)s/services/configs/conf-alert_actions/email?output_mode=json'
         record_url = url_tmpl % dict(server_uri=payload.get('server_uri'))
@@ -112,6 +127,7 @@ def getEmailAlertActions(argvals, payload):
         argvals['use_ssl'] = record['entry'][0]['content']['use_ssl']
         argvals['use_tls'] = record['entry'][0]['content']['use_tls']
         argvals['reportFileName'] = record['entry'][0]['content']['reportFileName']
+        confcache.store(payload.get('server_uri'), None, dict((key, argvals[key]) for key in EMAIL_SETTINGS), ttl)
     except six.moves.urllib.error.HTTPError as e:
         logger.error('invocation_id=%s invocation_type="%s" msg="Could not get email alert actions from splunk" error="%s"' % (INVOCATION_ID,INVOCATION_TYPE,str(e)))
         raise
@@ -141,6 +157,10 @@ def sendemail(recipient, sender, subject, body, argvals, attachment):
     use_tls   = intToBool(argvals['use_tls'])
     username  = getarg(argvals, "username"  , "")
     password  = getarg(argvals, "password"  , "")
+    idle_timeout = int(getarg(argvals, "smtp_idle_timeout", str(smtppool.IDLE_TIMEOUT)) or 0)
+    delivery     = (getarg(argvals, "delivery", "all") or "all").lower()
+    send_workers = int(getarg(argvals, "send_workers", str(mailstream.SEND_WORKERS)) or 1)
+    send_retries = int(getarg(argvals, "send_retries", str(mailstream.SEND_RETRIES)) or 0)
     
     # make sure the sender is a valid email address
     if (sender.find("@") == -1):
@@ -158,36 +178,29 @@ def sendemail(recipient, sender, subject, body, argvals, attachment):
     msg.attach(part1)
 
     try:
-        part2 = MIMEBase('application', "octet-stream")
-        part2.set_payload(open(os.environ['SPLUNK_HOME'] + "/var/run/splunk/" + attachment, "rb").read())
-        Encoders.encode_base64(part2)
-        part2.add_header('Content-Disposition', 'attachment; filename="' + attachment + '"')
-        msg.attach(part2)
+        # the attachment is encoded while it is sent, see mailstream
+        attachment_path = os.environ['SPLUNK_HOME'] + "/var/run/splunk/" + attachment
+        attachment_file = open(attachment_path, "rb")
+        message = mailstream.AttachmentMessage(msg, attachment_file, attachment)
     except Exception as e:
         print("exception while attaching file occured", file=sys.stderr)
         logger.error('invocation_id=%s invocation_type="%s" msg="error attaching file" rcpt="%s" error="%s"' % (INVOCATION_ID,INVOCATION_TYPE,recipient,str(e)))
         raise        
     try:
-        # send the mail
-        if not use_ssl:
-            print("plain jane mail", file=sys.stderr)
-            smtp = smtplib.SMTP(server)
+        # send the mail over a pooled connection, see smtppool
+        pool = smtppool.get_pool(server, use_ssl, use_tls, username, password, idle_timeout)
+        if delivery == "all":
+            with pool.connection() as smtp:
+                print("go go gadget - send email!", file=sys.stderr)
+                mailstream.send_message(smtp, sender, string.split(recipient, ","), message)
         else:
-            print("use ssl mail", file=sys.stderr)
-            smtp = smtplib.SMTP_SSL(server)
-
-        if use_tls:
-            print("use TLS", file=sys.stderr)
-            smtp.ehlo()
-            smtp.starttls()
-        if len(username) > 0 and len(password) >0:
-            print("user username/password", file=sys.stderr)
-            smtp.login(username, password)
-
-        #print >> sys.stderr, msg.as_string()
-        print("go go gadget - send email!", file=sys.stderr)
-        smtp.sendmail(sender, string.split(recipient, ","), msg.as_string())
-        smtp.quit()
+            # a copy per recipient or recipient domain, a bad address only fails its own copy
+            print("go go gadget - send email per %s!" % delivery, file=sys.stderr)
+            groups = mailstream.recipient_groups(string.split(recipient, ","), delivery)
+            results = mailstream.send_copies(pool, sender, groups, message, attachment_path, send_workers, send_retries)
+            failed = mailstream.report_copies(results, delivery, len(groups), INVOCATION_ID, INVOCATION_TYPE)
+            print(failed, file=sys.stderr)
+        print("smtp connections opened %d reused %d" % (pool.connects, pool.reuses), file=sys.stderr)
         return
     
     except smtplib.SMTPRecipientsRefused as e:
@@ -199,6 +212,8 @@ def sendemail(recipient, sender, subject, body, argvals, attachment):
     except (socket.error, smtplib.SMTPException) as e:
         print("exception while sending email occured", file=sys.stderr)
         print(e, file=sys.stderr)
+    finally:
+        attachment_file.close()
 
 
 
@@ -240,12 +255,23 @@ if __name__ == "__main__":
         search_name        = getarg(argvals, "search_name", "one")
         smptHost           = getarg(argvals, "server", "localhost")
         reportFileName     = getarg(argvals, "reportFileName", "")
+        row_batch_size     = int(getarg(settings, "row_batch_size", "1000") or 0)
+        output_format      = (getarg(settings, "format", "xls") or "xls").lower()
+        schema_sample_rows = int(getarg(settings, "schema_sample_rows", "100") or 0)
+        sst_memory_mb      = int(getarg(settings, "sst_memory_mb", "64") or 0)
+        compression        = (getarg(settings, "attachment_compression", "auto") or "auto").lower()
+        compress_threshold = int(getarg(settings, "compress_threshold_mb", "10") or 0)
+        # read by sendemail() along with the email alert settings
+        argvals['smtp_idle_timeout'] = getarg(settings, "smtp_idle_timeout", str(smtppool.IDLE_TIMEOUT))
+        argvals['delivery']          = getarg(settings, "delivery", "all")
+        argvals['send_workers']      = getarg(settings, "send_workers", str(mailstream.SEND_WORKERS))
+        argvals['send_retries']      = getarg(settings, "send_retries", str(mailstream.SEND_RETRIES))
         
         newFilename = search_name
         if filename!="":
             newFilename = filename
 
-        filename = reportFileName.replace("$name$",newFilename)+".xls"
+        filename = reportFileName.replace("$name$",newFilename)+"."+output_format
         regex = ur"\$time:([^$]+)\$"
         match = re.compile(regex).search(filename)
         if(match!=None):
@@ -259,43 +285,51 @@ if __name__ == "__main__":
 
             #--
             output = os.environ['SPLUNK_HOME'] + "/var/run/splunk/" + filename
-            logger.info("parameters used: outputfile %s" % (output))
-            int_re = re.compile(r'^\d+$')
-            float_re = re.compile(r'^\d+\.\d+$')
-            date_re = re.compile(r'^\d+-\d+-\d+|^\d+\/\d+\/\d+|^\d+\.\d+\.\d+')
-            style = xlwt.XFStyle()
-
-            workbook = xlwt.Workbook(encoding="UTF-8") #()
-            sheet = workbook.add_sheet(search_name)
-
-            column_num = 0
-            row_num = 0
-            for row in csvreader:
+            logger.info("parameters used: outputfile %s format %s row_batch_size %s sst_memory_mb %s" % (output, output_format, row_batch_size, sst_memory_mb))
+            workbook = new_workbook(output_format, output, sst_memory_mb * 1024 * 1024)
+            xf_indexes = add_format_styles(workbook)
+
+            # the first line holds the field names, skip stuff like __mv_ fields
+            header = next(csvreader, [])
+            columns = [i for i, name in enumerate(header) if not name.startswith('__')]
+
+            # pick one type and number format per column from the first rows,
+            # the remaining values only get classified if they don't fit
+            sample = list(itertools.islice(csvreader, schema_sample_rows))
+            inline_cols = []
+            if sample:
+                # rows shorter than the header get empty values like in the main loop
+                sample_values = [[row[i] if i < len(row) else "" for i in columns] for row in sample]
+                schema = infer_column_types(sample_values, len(columns))
+                logger.info("column types from %d sampled rows: %s" % (len(sample), schema))
+                converters = column_converters(schema)
+                # text columns without repeated values skip the shared string table
+                if output_format == 'xls':
+                    inline_cols = unique_text_columns(sample_values, len(columns))
+                    logger.info("columns written with inline strings: %s" % [header[columns[i]] for i in inline_cols])
+            else:
+                converters = [classify] * len(columns)
+
+            # new sheets are added once one is full, the header is repeated on each of them
+            sheets = SheetRoller(workbook, search_name, [header[i] for i in columns], row_batch_size, MAX_ROWS[output_format], inline_cols)
+
+            for row in itertools.chain(sample, csvreader):
+                values = []
+                formats = []
                 column_num = 0
-                for item in row:
-                    if not item.startswith('__'):
-                        format = 'general'
-                        cellvalue = ""
-                        if re.match(date_re, item):
-                            cellvalue = item
-                            format = 'M/D/YY'
-                        elif re.match(float_re, item):
-                            cellvalue = float(item)
-                            format = '0.00'
-                        elif re.match(int_re, item):
-                            cellvalue = float(item)
-                            format = '0'
-                        else:
-                            cellvalue = item
-                            format = ''
-                        style.num_format_str = format
-                        sheet.write(row_num, column_num, cellvalue, style) #sheet.write(row_num, column_num, unicode(item).encode("utf-8"), style)
-                        column_num += 1
-                row_num += 1
+                for i in columns:
+                    # fields missing at the end of a short row are empty
+                    celltype, cellvalue, format = converters[column_num](row[i] if i < len(row) else "")
+                    values.append(cellvalue)
+                    formats.append(xf_indexes[format])
+                    column_num += 1
+                sheets.write_row(values, formats)
                 #return True
                 
-            #save excel sheet
-            workbook.save(output)
+            #save excel sheet, zipped if it is large
+            attachment = save_workbook(workbook, output, output_format, compression, compress_threshold * 1024 * 1024)
+            filename = os.path.basename(attachment)
+            logger.info("attachment %s, %d bytes (compression %s)" % (filename, os.path.getsize(attachment), compression))
             
             try:
                 sendemail(recipient, sender, subject, bodyText, argvals, filename)
@@ -0,0 +1,175 @@
+###############################################################################
+###############################################################################
+##
+##  SENDXLSRESULTS - pooled SMTP connections shared by the sendxlsresults
+##  command and the sendxlsresults_alert action
+##
+##  Connecting, EHLO, STARTTLS and login are done once per connection. After
+##  a message is sent the connection goes back to the pool and is reused for
+##  the next message to the same server, until it was idle for longer than
+##  the idle timeout. The pools live as long as the process and are closed
+##  when it exits.
+##
+###############################################################################
+###############################################################################
+import atexit
+import contextlib
+import smtplib
+import socket
+import threading
+import time
+
+# seconds an authenticated connection is kept for the next message,
+# 0 closes every connection after its message
+IDLE_TIMEOUT = 60
+
+# idle connections kept per pool, connections beyond that are closed
+MAX_IDLE = 8
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+###############################################################################
+#
+# Class:      SMTPPool
+#
+# Descrition: Idle SMTP connections to one server with one set of
+#             credentials. acquire() hands out an idle connection that still
+#             answers NOOP or opens a new one, release() puts it back,
+#             discard() drops one that is in an unknown state. Safe to use
+#             from several threads.
+#
+# Arguments:
+#    server       - "host" or "host:port" as in the email alert settings.
+#    use_ssl      - connect with SMTP_SSL.
+#    use_tls      - STARTTLS after connecting.
+#    username     - login name, no login if username or password is empty.
+#    password     - login password.
+#    idle_timeout - seconds an idle connection is kept.
+#    max_idle     - idle connections kept.
+#
+###############################################################################
+
+class SMTPPool(object):
+
+    def __init__(self, server, use_ssl=False, use_tls=False, username='', password='',
+                 idle_timeout=IDLE_TIMEOUT, max_idle=MAX_IDLE):
+        self.server = server
+        self.use_ssl = use_ssl
+        self.use_tls = use_tls
+        self.username = username
+        self.password = password
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.connects = 0
+        self.reuses = 0
+        self.__idle = []
+        self.__lock = threading.Lock()
+
+    def __connect(self):
+        if self.use_ssl:
+            smtp = smtplib.SMTP_SSL(self.server)
+        else:
+            smtp = smtplib.SMTP(self.server)
+        try:
+            if self.use_tls:
+                smtp.ehlo()
+                smtp.starttls()
+                smtp.ehlo()
+            if self.username and self.password:
+                smtp.login(self.username, self.password)
+        except:
+            _close(smtp)
+            raise
+        with self.__lock:
+            self.connects += 1
+        return smtp
+
+    def acquire(self):
+        while True:
+            with self.__lock:
+                if not self.__idle:
+                    break
+                smtp, idle_since = self.__idle.pop()
+            if time.time() - idle_since > self.idle_timeout:
+                _close(smtp)
+                continue
+            try:
+                if smtp.noop()[0] == 250:
+                    with self.__lock:
+                        self.reuses += 1
+                    return smtp
+            except (socket.error, smtplib.SMTPException):
+                pass
+            _close(smtp)
+        return self.__connect()
+
+    def release(self, smtp):
+        if self.idle_timeout <= 0:
+            _close(smtp)
+            return
+        with self.__lock:
+            if len(self.__idle) < self.max_idle:
+                self.__idle.append((smtp, time.time()))
+                return
+        _close(smtp)
+
+    def discard(self, smtp):
+        # no QUIT, the server may still be waiting for the rest of a message
+        smtp.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        # a connection for one or more messages, it goes back to the pool
+        # if the server answered (like refusing recipients), after anything
+        # else its state is unknown and it is closed
+        smtp = self.acquire()
+        try:
+            yield smtp
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            self.release(smtp)
+            raise
+        except:
+            self.discard(smtp)
+            raise
+        self.release(smtp)
+
+    def close(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for smtp, idle_since in idle:
+            _close(smtp)
+
+def _close(smtp):
+    try:
+        smtp.quit()
+    except (socket.error, smtplib.SMTPException):
+        smtp.close()
+
+###############################################################################
+#
+# Function:   get_pool
+#
+# Descrition: Returns the pool for a server and set of credentials, creating
+#             it on first use, so all messages sent by one process to the
+#             same server share their connections.
+#
+# Arguments:  see SMTPPool.
+#
+###############################################################################
+
+def get_pool(server, use_ssl=False, use_tls=False, username='', password='', idle_timeout=IDLE_TIMEOUT):
+    key = (server, bool(use_ssl), bool(use_tls), username, password)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = SMTPPool(server, use_ssl, use_tls, username, password, idle_timeout)
+        return pool
+
+@atexit.register
+def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
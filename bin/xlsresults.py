@@ -0,0 +1,209 @@
+###############################################################################
+###############################################################################
+##
+##  SENDXLSRESULTS - shared workbook writing helpers used by the
+##  sendxlsresults command and the sendxlsresults_alert action
+##
+###############################################################################
+###############################################################################
+from __future__ import print_function
+import os
+import re
+import sys
+import zipfile
+import xlwt
+import xlsxstream
+from celltypes import NUM_FORMATS
+
+# BIFF8 allows 65536 rows per sheet (row indexes 0 - 65535)
+XLS_MAX_ROWS = 65536
+
+# rows per sheet for each supported output format
+MAX_ROWS = {
+    'xls': XLS_MAX_ROWS,
+    'xlsx': xlsxstream.MAX_ROWS,
+}
+
+# Excel limits sheet names to 31 characters
+SHEET_NAME_MAX_LEN = 31
+
+# characters Excel does not allow in sheet names, search names often have
+# ":" or "/" in them
+_invalid_sheet_name_re = re.compile(r'[\[\]:\\?/*\x00]')
+
+# attachment_compression settings: zip above a size threshold, always, never
+ATTACHMENT_COMPRESSIONS = ('auto', 'zip', 'none')
+
+# Python 3.6+ can write a zip entry as a stream, so the xls goes straight
+# into the zip while it is saved
+ZIP_STREAMING = sys.version_info >= (3, 6)
+
+###############################################################################
+#
+# Function:   rollover_sheet_name
+#
+# Descrition: Returns the name of the n-th sheet for a search, i.e.
+#             "search_name", "search_name (2)", "search_name (3)", ...
+#             The search name is shortened to SHEET_NAME_MAX_LEN characters,
+#             less the suffix, so long search names and the suffix always fit.
+#             Characters not allowed in sheet names are replaced with "_",
+#             as is a leading quote; an empty name becomes "Sheet".
+#
+###############################################################################
+
+def rollover_sheet_name(search_name, sheet_num):
+    if isinstance(search_name, bytes):
+        # count characters, not UTF-8 bytes, when shortening the name
+        search_name = search_name.decode('utf-8')
+    search_name = _invalid_sheet_name_re.sub(u'_', search_name)
+    if search_name.startswith(u"'"):
+        search_name = u'_' + search_name[1:]
+    search_name = search_name or u'Sheet'
+    suffix = u" (%d)" % sheet_num if sheet_num > 1 else u""
+    return search_name[:SHEET_NAME_MAX_LEN - len(suffix)] + suffix
+
+###############################################################################
+#
+# Function:   new_workbook
+#
+# Descrition: Creates the workbook for the requested output format. The xlsx
+#             writer streams rows straight into the output file, so it needs
+#             to know the file up front; both are finished with save(output).
+#
+# Arguments:
+#    output_format    - "xls" (xlwt, BIFF8) or "xlsx" (xlsxstream).
+#    output           - file name or stream the workbook will be saved to.
+#    sst_memory_limit - xls only: bytes of shared strings kept in memory,
+#                       more unique strings go to temp files. 0 = no limit.
+#
+###############################################################################
+
+def new_workbook(output_format, output, sst_memory_limit=0):
+    if output_format == 'xlsx':
+        return xlsxstream.Workbook(output, encoding="UTF-8")
+    if output_format == 'xls':
+        return xlwt.Workbook(encoding="UTF-8", compact_rows=True, sst_memory_limit=sst_memory_limit)
+    raise ValueError("unsupported format %r, expected xls or xlsx" % output_format)
+
+###############################################################################
+#
+# Function:   save_workbook
+#
+# Descrition: Saves the workbook and wraps it in a zip if asked to. With
+#             "auto" xls files above the size threshold are zipped, xlsx
+#             files never (they are zip files already). The file is added
+#             to the zip in chunks, or streamed into it while it is written
+#             where zipfile can do that, it never has to fit in memory.
+#
+# Arguments:
+#    workbook      - the xlwt or xlsxstream Workbook to save.
+#    output        - file name the workbook is saved as.
+#    output_format - "xls" or "xlsx".
+#    compression   - "auto", "zip" or "none", see ATTACHMENT_COMPRESSIONS.
+#    threshold     - size in bytes from which "auto" zips the file.
+#
+# Returns:    the name of the file to attach, output or output + ".zip".
+#
+###############################################################################
+
+def save_workbook(workbook, output, output_format, compression='none', threshold=0):
+    if compression not in ATTACHMENT_COMPRESSIONS:
+        raise ValueError("unsupported attachment compression %r, expected one of %s"
+                         % (compression, ", ".join(ATTACHMENT_COMPRESSIONS)))
+    zip_output = output + '.zip'
+    arcname = os.path.basename(output)
+    if compression == 'zip' and output_format == 'xls' and ZIP_STREAMING:
+        with zipfile.ZipFile(zip_output, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            with archive.open(arcname, 'w', force_zip64=True) as entry:
+                workbook.save(entry)
+        return zip_output
+    workbook.save(output)
+    if compression == 'none' or (compression == 'auto' and
+            (output_format != 'xls' or os.path.getsize(output) <= threshold)):
+        return output
+    with zipfile.ZipFile(zip_output, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        archive.write(output, arcname)
+    os.remove(output)
+    return zip_output
+
+###############################################################################
+#
+# Function:   add_format_styles
+#
+# Descrition: Registers one style per number format with the workbook, so
+#             cells can be written with Worksheet.write_xf() and no style has
+#             to be looked up (or mutated) per cell.
+#
+# Returns:    dict of number format -> XF index.
+#
+###############################################################################
+
+def add_format_styles(workbook, num_formats=NUM_FORMATS):
+    styles = []
+    for num_format in num_formats:
+        style = xlwt.XFStyle()
+        style.num_format_str = num_format
+        styles.append(style)
+    return dict(zip(num_formats, workbook.add_styles(styles)))
+
+###############################################################################
+#
+# Class:      SheetRoller
+#
+# Descrition: Hands out (sheet, row index) pairs for result rows. When a sheet
+#             is full a new one is added to the workbook and the header row is
+#             repeated on it. If row_batch_size is > 0 the rows of the current
+#             sheet are flushed to the sheet's temp file every row_batch_size
+#             rows, so memory use does not depend on the size of the results.
+#             write_row() writes a whole result row with Worksheet.write_row().
+#
+# Arguments:
+#    workbook           - the xlwt or xlsxstream Workbook to add sheets to.
+#    search_name        - name of the first sheet, later sheets get a " (n)" suffix.
+#    header             - list of column names written as first row of each sheet.
+#    row_batch_size     - flush interval in rows, 0 disables flushing.
+#    max_rows           - rows per sheet including the header row.
+#    inline_string_cols - xls only: columns written with inline strings instead
+#                         of the shared string table (see unique_text_columns).
+#
+###############################################################################
+
+class SheetRoller(object):
+
+    def __init__(self, workbook, search_name, header, row_batch_size=0, max_rows=XLS_MAX_ROWS,
+                 inline_string_cols=()):
+        self.workbook = workbook
+        self.search_name = search_name
+        self.header = header
+        self.row_batch_size = row_batch_size
+        self.max_rows = max_rows
+        self.inline_string_cols = inline_string_cols
+        self.sheet = None
+        self.sheet_num = 0
+        self.row_num = 0
+        self.add_sheet()
+
+    def add_sheet(self):
+        self.sheet_num += 1
+        self.sheet = self.workbook.add_sheet(rollover_sheet_name(self.search_name, self.sheet_num))
+        if self.inline_string_cols:
+            self.sheet.set_inline_string_cols(self.inline_string_cols)
+        for column_num, name in enumerate(self.header):
+            self.sheet.write(0, column_num, name)
+        self.row_num = 1
+        return self.sheet
+
+    def next_row(self):
+        if self.row_num >= self.max_rows:
+            if self.row_batch_size > 0:
+                self.sheet.flush_row_data()
+            self.add_sheet()
+        elif self.row_batch_size > 0 and self.row_num % self.row_batch_size == 0:
+            self.sheet.flush_row_data()
+        row_num = self.row_num
+        self.row_num += 1
+        return self.sheet, row_num
+
+    def write_row(self, values, xf_indexes):
+        sheet, row_num = self.next_row()
+        sheet.write_row(row_num, values, xf_indexes)
@@ -0,0 +1,379 @@
+###############################################################################
+###############################################################################
+##
+##  XLSXSTREAM - a small streaming XLSX (Office Open XML) writer
+##
+##  Only needs the standard library. Rows are written to the zip entry of
+##  their sheet as they come in, strings are stored inline (no shared string
+##  table), so memory use does not depend on the number of rows.
+##
+##  The interface follows the parts of xlwt used by sendxlsresults:
+##  Workbook.add_sheet(), Workbook.add_styles(), Worksheet.write(r, c, label,
+##  style), Worksheet.write_xf(r, c, label, xf_index), Worksheet.write_row(),
+##  Worksheet.write_rows(), Worksheet.flush_row_data() and Workbook.save().
+##
+###############################################################################
+###############################################################################
+import os
+import re
+import sys
+import tempfile
+import zipfile
+
+PY3 = sys.version_info[0] >= 3
+if PY3:
+    unicode_type = str
+    basestring_type = str
+    number_types = (int, float)
+else:
+    unicode_type = unicode
+    basestring_type = basestring
+    number_types = (int, long, float)
+
+# Office Open XML limits
+MAX_ROWS = 1048576
+MAX_COLS = 16384
+
+# rows are collected and written to the zip entry in chunks of this many bytes
+WRITE_CHUNK_SIZE = 64 * 1024
+
+# characters Excel does not allow in sheet names
+_invalid_sheet_name_chars = u'[]:\\?/*\x00'
+
+# characters that are not allowed in XML 1.0
+_illegal_xml_chars_re = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+# number formats Excel knows without a <numFmt> entry
+_builtin_num_formats = {
+    'general': 0,
+    'General': 0,
+    '': 0,
+    '0': 1,
+    '0.00': 2,
+    '#,##0': 3,
+    '#,##0.00': 4,
+    '0%': 9,
+    '0.00%': 10,
+    '0.00E+00': 11,
+    'M/D/YY': 14,
+    'm/d/yy': 14,
+    'h:mm': 20,
+    'h:mm:ss': 21,
+    'M/D/YY h:mm': 22,
+}
+
+_CONTENT_TYPES_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>')
+
+_CONTENT_TYPES_SHEET = (
+    '<Override PartName="/xl/worksheets/sheet%d.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>')
+
+_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>')
+
+_WORKBOOK_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>')
+
+_WORKBOOK_RELS_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">')
+
+_WORKBOOK_RELS_SHEET = (
+    '<Relationship Id="rId%d" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet%d.xml"/>')
+
+_WORKBOOK_RELS_STYLES = (
+    '<Relationship Id="rId%d" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>')
+
+_SHEET_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+
+_SHEET_END = '</sheetData></worksheet>'
+
+
+def col_name(colx):
+    # 0 -> A, 25 -> Z, 26 -> AA, ...
+    name = ''
+    colx += 1
+    while colx:
+        colx, rem = divmod(colx - 1, 26)
+        name = chr(65 + rem) + name
+    return name
+
+
+def xml_escape(s):
+    s = s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return _illegal_xml_chars_re.sub(u'', s)
+
+
+class Worksheet(object):
+    """
+    A sheet of a streaming workbook. Rows have to be written in increasing
+    order; a row is written out as soon as a cell of a later row is written.
+
+    .. warning::
+
+      Don't create instances yourself, use :meth:`Workbook.add_sheet`.
+    """
+
+    def __init__(self, name, parent_book, sheet_num, stream):
+        self.name = name
+        self.__parent = parent_book
+        self.sheet_num = sheet_num
+        self.__stream = stream
+        self.__pending = []
+        self.__pending_len = 0
+        self.__rowx = None
+        self.__cells = []
+        self.__last_rowx = -1
+        self.__write_raw(_SHEET_START)
+
+    def get_parent(self):
+        return self.__parent
+
+    def __write_raw(self, s):
+        self.__pending.append(s)
+        self.__pending_len += len(s)
+        if self.__pending_len >= WRITE_CHUNK_SIZE:
+            self.__write_pending()
+
+    def __write_pending(self):
+        if self.__pending:
+            self.__stream.write(u''.join(self.__pending).encode('utf-8'))
+            self.__pending = []
+            self.__pending_len = 0
+
+    def __end_row(self):
+        if self.__rowx is not None:
+            self.__write_raw(u'<row r="%d">%s</row>' % (self.__rowx + 1, u''.join(self.__cells)))
+            self.__last_rowx = self.__rowx
+            self.__rowx = None
+            self.__cells = []
+
+    def write(self, r, c, label="", style=None):
+        self.write_xf(r, c, label, self.__parent.add_style(style))
+
+    def __start_row(self, r):
+        if r <= self.__last_rowx or (self.__rowx is not None and r < self.__rowx):
+            raise Exception("rows have to be written in increasing order, row %d of sheet %r came too late" % (r, self.name))
+        if not 0 <= r < MAX_ROWS:
+            raise ValueError("row index was %r, not allowed by .xlsx format" % r)
+        self.__end_row()
+        self.__rowx = r
+
+    def __cell_xml(self, ref, label, xf_idx):
+        s_attr = xf_idx and (u' s="%d"' % xf_idx) or u''
+        if label is None or (isinstance(label, basestring_type) and len(label) == 0):
+            if xf_idx:
+                return u'<c r="%s"%s/>' % (ref, s_attr)
+            return u''
+        elif isinstance(label, bool):
+            return u'<c r="%s"%s t="b"><v>%d</v></c>' % (ref, s_attr, label)
+        elif isinstance(label, float) and label - label != 0:
+            # inf and nan are no valid xsd:double, they are written as text
+            label = repr(label)
+        elif isinstance(label, number_types):
+            if isinstance(label, float):
+                value = repr(label)
+            else:
+                value = '%d' % label
+            return u'<c r="%s"%s><v>%s</v></c>' % (ref, s_attr, value)
+        if not isinstance(label, unicode_type):
+            if isinstance(label, bytes):
+                label = label.decode(self.__parent.encoding)
+            else:
+                label = unicode_type(label)
+        if label[:1].isspace() or label[-1:].isspace():
+            t_tag = u'<t xml:space="preserve">'
+        else:
+            t_tag = u'<t>'
+        return u'<c r="%s"%s t="inlineStr"><is>%s%s</t></is></c>' % (ref, s_attr, t_tag, xml_escape(label))
+
+    def write_xf(self, r, c, label, xf_idx):
+        if r != self.__rowx:
+            self.__start_row(r)
+        if not 0 <= c < MAX_COLS:
+            raise ValueError("column index (%r) not an int in range(%d)" % (c, MAX_COLS))
+        self.__cells.append(self.__cell_xml(self.__parent.cell_ref(r, c), label, xf_idx))
+
+    def write_row(self, r, values, xf_indexes, first_col=0):
+        ncols = len(values)
+        if len(xf_indexes) != ncols:
+            raise ValueError("got %d values but %d XF indexes" % (ncols, len(xf_indexes)))
+        if not 0 <= first_col <= first_col + ncols <= MAX_COLS:
+            raise ValueError("columns %d to %d not in range(%d)" % (first_col, first_col + ncols - 1, MAX_COLS))
+        if r != self.__rowx:
+            self.__start_row(r)
+        cell_ref = self.__parent.cell_ref
+        cell_xml = self.__cell_xml
+        self.__cells.extend(cell_xml(cell_ref(r, c), label, xf_idx)
+                            for c, label, xf_idx in zip(range(first_col, first_col + ncols), values, xf_indexes))
+
+    def write_rows(self, start_row, rows):
+        r = start_row
+        for values, xf_indexes in rows:
+            self.write_row(r, values, xf_indexes)
+            r += 1
+        return r
+
+    def flush_row_data(self):
+        self.__end_row()
+        self.__write_pending()
+
+    def close(self):
+        self.__end_row()
+        self.__write_raw(_SHEET_END)
+        self.__write_pending()
+
+
+def _valid_sheet_name(sheetname):
+    # same rules as xlwt.Utils.valid_sheet_name(), Excel reports a file with
+    # any other name as corrupt
+    if sheetname == u"" or sheetname[0] == u"'" or len(sheetname) > 31:
+        return False
+    for c in sheetname:
+        if c in _invalid_sheet_name_chars:
+            return False
+    return True
+
+
+class Workbook(object):
+    """
+    A streaming XLSX workbook. As rows go straight to the output, the file
+    (or stream) is given when the workbook is created and :meth:`save` only
+    adds the parts that can be written once all sheets are known.
+    """
+
+    def __init__(self, filename_or_stream, encoding='utf-8'):
+        self.encoding = encoding
+        self.__target = filename_or_stream
+        self.__zip = zipfile.ZipFile(filename_or_stream, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.__worksheets = []
+        self.__worksheet_names = {}
+        self.__sheet = None
+        self.__sheet_stream = None
+        self.__spool_name = None
+        self.__num_formats = {}
+        self.__styles = {}
+        self.__style_formats = []
+        self.__col_names = []
+
+    def cell_ref(self, rowx, colx):
+        col_names = self.__col_names
+        while colx >= len(col_names):
+            col_names.append(col_name(len(col_names)))
+        return '%s%d' % (col_names[colx], rowx + 1)
+
+    def add_style(self, style):
+        # Only the number format of a style is used. Returns the cellXfs index.
+        if style is None:
+            return 0
+        num_format_str = getattr(style, 'num_format_str', 'General')
+        xf_idx = self.__styles.get(num_format_str)
+        if xf_idx is None:
+            if num_format_str in _builtin_num_formats:
+                num_fmt_id = _builtin_num_formats[num_format_str]
+            else:
+                num_fmt_id = self.__num_formats.setdefault(num_format_str, 164 + len(self.__num_formats))
+            if num_fmt_id == 0 and not self.__style_formats:
+                xf_idx = 0
+            else:
+                xf_idx = len(self.__style_formats) + 1
+                self.__style_formats.append(num_fmt_id)
+            self.__styles[num_format_str] = xf_idx
+        return xf_idx
+
+    def add_styles(self, styles):
+        return [self.add_style(style) for style in styles]
+
+    def __open_entry(self, arcname):
+        # Python 3.6+ can stream into a zip entry, older versions get the
+        # entry spooled to a temp file which is compressed into the zip later.
+        if sys.version_info >= (3, 6):
+            return self.__zip.open(arcname, 'w', force_zip64=True)
+        fd, self.__spool_name = tempfile.mkstemp(suffix='.xml')
+        return os.fdopen(fd, 'wb')
+
+    def __close_sheet(self):
+        if self.__sheet is None:
+            return
+        self.__sheet.close()
+        self.__sheet_stream.close()
+        if self.__spool_name is not None:
+            self.__zip.write(self.__spool_name, 'xl/worksheets/sheet%d.xml' % self.__sheet.sheet_num)
+            os.remove(self.__spool_name)
+            self.__spool_name = None
+        self.__sheet = None
+        self.__sheet_stream = None
+
+    def add_sheet(self, sheetname):
+        """
+        Adds a sheet and makes it the one rows are written to. The previous
+        sheet is finished and can't be written to any more.
+        """
+        if not isinstance(sheetname, unicode_type):
+            sheetname = sheetname.decode(self.encoding)
+        if not _valid_sheet_name(sheetname):
+            raise Exception("invalid worksheet name %r" % sheetname)
+        lower_name = sheetname.lower()
+        if lower_name in self.__worksheet_names:
+            raise Exception("duplicate worksheet name %r" % sheetname)
+        self.__close_sheet()
+        sheet_num = len(self.__worksheets) + 1
+        self.__worksheet_names[lower_name] = sheet_num
+        self.__sheet_stream = self.__open_entry('xl/worksheets/sheet%d.xml' % sheet_num)
+        self.__sheet = Worksheet(sheetname, self, sheet_num, self.__sheet_stream)
+        self.__worksheets.append(self.__sheet)
+        return self.__sheet
+
+    def __styles_xml(self):
+        num_fmts = u''.join(u'<numFmt numFmtId="%d" formatCode="%s"/>' % (num_fmt_id, xml_escape(code).replace('"', '&quot;'))
+                            for code, num_fmt_id in sorted(self.__num_formats.items(), key=lambda item: item[1]))
+        if num_fmts:
+            num_fmts = u'<numFmts count="%d">%s</numFmts>' % (len(self.__num_formats), num_fmts)
+        xfs = [u'<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>']
+        for num_fmt_id in self.__style_formats:
+            xfs.append(u'<xf numFmtId="%d" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>' % num_fmt_id)
+        return (u'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                u'<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">%s'
+                u'<fonts count="1"><font><sz val="10"/><name val="Arial"/></font></fonts>'
+                u'<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+                u'<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+                u'<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+                u'<cellXfs count="%d">%s</cellXfs>'
+                u'<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+                u'</styleSheet>') % (num_fmts, len(xfs), u''.join(xfs))
+
+    def save(self, filename_or_stream=None):
+        """
+        Finishes the last sheet and writes the workbook parts. The target
+        is the one given to the constructor.
+        """
+        if filename_or_stream is not None and filename_or_stream != self.__target:
+            raise Exception("a streaming workbook can only be saved to the file it was created with")
+        if not self.__worksheets:
+            self.add_sheet(u'Sheet1')
+        self.__close_sheet()
+        n_sheets = len(self.__worksheets)
+        self.__zip.writestr('[Content_Types].xml', _CONTENT_TYPES_START +
+            ''.join(_CONTENT_TYPES_SHEET % (i + 1) for i in range(n_sheets)) + '</Types>')
+        self.__zip.writestr('_rels/.rels', _ROOT_RELS)
+        workbook_xml = _WORKBOOK_START + u''.join(
+            u'<sheet name="%s" sheetId="%d" r:id="rId%d"/>' % (xml_escape(sheet.name).replace('"', '&quot;'), i + 1, i + 1)
+            for i, sheet in enumerate(self.__worksheets)) + u'</sheets></workbook>'
+        self.__zip.writestr('xl/workbook.xml', workbook_xml.encode('utf-8'))
+        self.__zip.writestr('xl/_rels/workbook.xml.rels', _WORKBOOK_RELS_START +
+            ''.join(_WORKBOOK_RELS_SHEET % (i + 1, i + 1) for i in range(n_sheets)) +
+            _WORKBOOK_RELS_STYLES % (n_sheets + 1) + '</Relationships>')
+        self.__zip.writestr('xl/styles.xml', self.__styles_xml().encode('utf-8'))
+        self.__zip.close()
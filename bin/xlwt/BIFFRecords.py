@@ -1,36 +1,91 @@
 # -*- coding: cp1252 -*-
+import sys
+import tempfile
+from bisect import bisect_right
 from struct import pack
-from .UnicodeUtils import upack1, upack2, upack2rt
-from .compat import basestring, unicode, unicode_type, xrange, iteritems
+from array import array
+from .UnicodeUtils import upack1, upack2, upack2rt, upack2_many
+from .compat import unicode, unicode_type, xrange
+from .StringIndex import DiskStringIndex
 
 class SharedStringTable(object):
+    """
+    New unique strings are queued and encoded into the SST record data in
+    batches (see :func:`~xlwt.UnicodeUtils.upack2_many`). The data is kept
+    as a list of pieces of at most 0x2020 bytes (the SST record and its
+    CONTINUE records), so saving only has to prefix the pieces with their
+    record headers.
+
+    The position of every 8th string is recorded as well, for the EXTSST
+    record written after the SST (see :meth:`get_ext_sst_record`).
+
+    If memory_limit is set, the table switches to a disk backed mode once
+    the strings and their encoded data (roughly) use more than memory_limit
+    bytes: strings added after that are looked up in a
+    :class:`~xlwt.StringIndex.DiskStringIndex` and the completed CONTINUE
+    records are written to a temporary file, which is copied into the
+    workbook stream on save.
+
+    Strings whose cells were all overwritten stay in the table, unused.
+    """
     _SST_ID = 0x00FC
     _CONTINUE_ID = 0x003C
-
-    def __init__(self, encoding):
+    _MAX_PIECE_LEN = 0x2020
+    _EXT_SST_STEP = 8   # the minimum number of strings per EXTSST bucket
+    _EXT_SST_MAX_BUCKETS = 128
+    # estimated bytes used per string besides the string and its encoding
+    # (dict slot, index and tally)
+    _STR_OVERHEAD = 64
+    # queued strings are encoded once there are this many of them, or
+    # this many characters
+    _BATCH_STRINGS = 4096
+    _BATCH_CHARS = 1 << 20
+
+    def __init__(self, encoding, memory_limit=0):
         self.encoding = encoding
         self._str_indexes = {}
         self._rt_indexes = {}
-        self._tally = []
+        self._tally = array('I')
         self._add_calls = 0
-        # Following 3 attrs are used for temporary storage in the
-        # get_biff_record() method and methods called by it. The pseudo-
-        # initialisation here is for documentation purposes only.
-        self._sst_record = None
-        self._continues = None
-        self._current_piece = None
+        self._memory_limit = memory_limit
+        self._memory_used = 0
+        # set once memory_limit is reached
+        self._spill_index = None
+        self._spill_file = None
+        # Completed pieces, the first one is the SST record data. The
+        # current piece starts with 8 placeholder bytes for the string
+        # counts, which are only known at save time.
+        self._pieces = []
+        self._piece_lens = array('H')
+        self._current_piece = bytearray(8)
+        # new strings that are not encoded yet
+        self._batch = []
+        self._batch_chars = 0
+        # piece number and offset in the piece of every 8th string
+        self._ext_sst_pieces = array('I')
+        self._ext_sst_offsets = array('H')
 
     def add_str(self, s):
         if self.encoding != 'ascii' and not isinstance(s, unicode_type):
             s = unicode(s, self.encoding)
         self._add_calls += 1
-        if s not in self._str_indexes:
-            idx = len(self._str_indexes) + len(self._rt_indexes)
-            self._str_indexes[s] = idx
-            self._tally.append(1)
-        else:
-            idx = self._str_indexes[s]
+        idx = self._str_indexes.get(s)
+        if idx is not None:
             self._tally[idx] += 1
+            return idx
+        idx = len(self._tally)
+        if self._spill_index is not None:
+            spilled_idx = self._spill_index.setdefault(s, idx)
+            if spilled_idx != idx:
+                self._tally[spilled_idx] += 1
+                return spilled_idx
+        else:
+            self._str_indexes[s] = idx
+        self._tally.append(1)
+        self._batch.append(s)
+        self._batch_chars += len(s)
+        if len(self._batch) >= self._BATCH_STRINGS or self._batch_chars >= self._BATCH_CHARS:
+            self._encode_batch()
         return idx
 	
     def add_rt(self, rt):
@@ -42,9 +97,11 @@ class SharedStringTable(object):
         rt = tuple(rtList)
         self._add_calls += 1
         if rt not in self._rt_indexes:
-            idx = len(self._str_indexes) + len(self._rt_indexes)
+            self._encode_batch() # keep the strings in index order
+            idx = len(self._tally)
             self._rt_indexes[rt] = idx
             self._tally.append(1)
+            self._add_rt_to_sst(rt)
         else:
             idx = self._rt_indexes[rt]
             self._tally[idx] += 1
@@ -58,39 +115,93 @@ class SharedStringTable(object):
         self._add_calls -= 1
 
     def str_index(self, s):
-        return self._str_indexes[s]
+        idx = self._str_indexes.get(s)
+        if idx is None and self._spill_index is not None:
+            idx = self._spill_index.get(s)
+        if idx is None:
+            raise KeyError(s)
+        return idx
 
     def rt_index(self, rt):
         return self._rt_indexes[rt]
 
-    def get_biff_record(self):
-        self._sst_record = b''
-        self._continues = [None, None]
-        self._current_piece = pack('<II', 0, 0)
-        data = [(idx, s) for s, idx in iteritems(self._str_indexes)]
-        data.extend((idx, s) for s, idx in iteritems(self._rt_indexes))
-        data.sort() # in index order
-        for idx, s in data:
-            if self._tally[idx] == 0:
-                s = u''
-            if isinstance(s, basestring):
-                self._add_to_sst(s)
-            else:
-                self._add_rt_to_sst(s)
-        del data
-        self._new_piece()
-        self._continues[0] = pack('<2HII', self._SST_ID, len(self._sst_record), self._add_calls, len(self._str_indexes) + len(self._rt_indexes))
-        self._continues[1] = self._sst_record[8:]
-        self._sst_record = None
-        self._current_piece = None
-        result = b''.join(self._continues)
-        self._continues = None
+    def get_biff_buffers(self):
+        """
+        Returns the SST record and its CONTINUE records as a list of byte
+        strings. Strings can still be added afterwards.
+        """
+        self._encode_batch()
+        pieces = self._pieces + [bytes(self._current_piece)]
+        first = pieces[0]
+        result = [
+            pack('<2HII', self._SST_ID, len(first), self._add_calls, len(self._tally)),
+            first[8:],
+            ]
+        if self._spill_file is not None:
+            # CONTINUE records between the first and the current piece
+            result.append(self._spill_file)
+        for piece in pieces[1:]:
+            result.append(pack('<2H', self._CONTINUE_ID, len(piece)))
+            result.append(piece)
         return result
 
+    def get_biff_record(self):
+        return b''.join(self.get_biff_buffers())
 
-    def _add_to_sst(self, s):
-        u_str = upack2(s, self.encoding)
-
+    def get_ext_sst_record(self, sst_stream_pos):
+        """
+        Returns the EXTSST record for the SST record written at stream
+        position sst_stream_pos. The strings are split into at most 128
+        buckets of a multiple of 8 strings, so the recorded positions of
+        every 8th string are all that is needed.
+        """
+        self._encode_batch()
+        step = max(1, -(-len(self._ext_sst_pieces) // self._EXT_SST_MAX_BUCKETS))
+        bucket_placement = [
+            (self._ext_sst_pieces[i], self._ext_sst_offsets[i])
+            for i in xrange(0, len(self._ext_sst_pieces), step)
+            ]
+        portions_len = list(self._piece_lens)
+        portions_len.append(len(self._current_piece))
+        return ExtSSTRecord(sst_stream_pos, self._EXT_SST_STEP * step,
+                            bucket_placement, portions_len).get()
+
+
+    def _encode_batch(self):
+        batch = self._batch
+        if not batch:
+            return
+        self._batch = []
+        self._batch_chars = 0
+        data, ends = upack2_many(batch, self.encoding)
+        first_idx = len(self._tally) - len(batch)
+        step = self._EXT_SST_STEP
+        start = 0
+        i = 0
+        while i < len(ends):
+            piece_len = len(self._current_piece)
+            # strings i to j-1 fit into the current piece as they are
+            j = bisect_right(ends, start + self._MAX_PIECE_LEN - piece_len, i)
+            if j == i:
+                self._add_to_sst(data[start:ends[i]], first_idx + i)
+                start = ends[i]
+                i += 1
+                continue
+            for k in xrange(i + (-(first_idx + i)) % step, j, step):
+                str_start = ends[k - 1] if k else 0
+                self._ext_sst_pieces.append(len(self._piece_lens))
+                self._ext_sst_offsets.append(piece_len + str_start - start)
+            self._current_piece += data[start:ends[j - 1]]
+            start = ends[j - 1]
+            i = j
+        if self._memory_limit and self._spill_index is None:
+            self._memory_used += len(data) + sum(sys.getsizeof(s) + self._STR_OVERHEAD for s in batch)
+            if self._memory_used > self._memory_limit:
+                self._start_spilling()
+
+    def _add_to_sst(self, u_str, idx):
+        # Adds a string encoded by upack2() that doesn't fit into the
+        # current piece.
         is_unicode_str = u_str[2] == b'\x01'[0]
         if is_unicode_str:
             atom_len = 5 # 2 byte -- len,
@@ -101,6 +212,7 @@ class SharedStringTable(object):
                          # 1 byte -- options,
                          # 1 byte -- 1st sym
 
+        self._start_string(atom_len, idx)
         self._save_atom(u_str[0:atom_len])
         self._save_splitted(u_str[atom_len:], is_unicode_str)
 	
@@ -117,22 +229,42 @@ class SharedStringTable(object):
                          # 1 byte -- options,
                          # 2 byte -- number of rt runs
                          # 1 byte -- 1st sym
+        self._start_string(atom_len, len(self._tally) - 1)
         self._save_atom(rt_str[0:atom_len])
         self._save_splitted(rt_str[atom_len:], is_unicode_str)
         for i in range(0, len(rt_fr), 4):
             self._save_atom(rt_fr[i:i+4])
 
+    def _start_string(self, atom_len, idx):
+        # The first atom of a string is never split, so the string starts
+        # in the current piece if the atom fits, else in a new one.
+        if self._MAX_PIECE_LEN - len(self._current_piece) < atom_len:
+            self._new_piece()
+        if idx % self._EXT_SST_STEP == 0:
+            self._ext_sst_pieces.append(len(self._piece_lens))
+            self._ext_sst_offsets.append(len(self._current_piece))
+
     def _new_piece(self):
-        if self._sst_record == b'':
-            self._sst_record = self._current_piece
+        piece = bytes(self._current_piece)
+        self._piece_lens.append(len(piece))
+        if self._spill_file is not None and self._pieces:
+            self._spill_file.write(pack('<2H', self._CONTINUE_ID, len(piece)))
+            self._spill_file.write(piece)
         else:
-            curr_piece_len = len(self._current_piece)
-            self._continues.append(pack('<2H%ds'%curr_piece_len, self._CONTINUE_ID, curr_piece_len, self._current_piece))
-        self._current_piece = b''
+            self._pieces.append(piece)
+        self._current_piece = bytearray()
+
+    def _start_spilling(self):
+        self._spill_index = DiskStringIndex()
+        self._spill_file = tempfile.TemporaryFile()
+        for piece in self._pieces[1:]:
+            self._spill_file.write(pack('<2H', self._CONTINUE_ID, len(piece)))
+            self._spill_file.write(piece)
+        del self._pieces[1:]
 
     def _save_atom(self, s):
         atom_len = len(s)
-        free_space = 0x2020 - len(self._current_piece)
+        free_space = self._MAX_PIECE_LEN - len(self._current_piece)
         if free_space < atom_len:
             self._new_piece()
         self._current_piece += s
@@ -142,7 +274,7 @@ class SharedStringTable(object):
         str_len = len(s)
         while i < str_len:
             piece_len = len(self._current_piece)
-            free_space = 0x2020 - piece_len
+            free_space = self._MAX_PIECE_LEN - piece_len
             tail_len = str_len - i
             need_more_space = free_space < tail_len
 
@@ -1188,27 +1320,26 @@ class ExtSSTRecord(BiffRecord):
     """
     _REC_ID = 0x00FF
 
-    def __init__(self, sst_stream_pos, str_placement, portions_len):
-        extsst = {}
-        abs_stream_pos = sst_stream_pos
-        str_counter = 0
-        portion_counter = 0
-        while str_counter < len(str_placement):
-            str_chunk_num, pos_in_chunk = str_placement[str_counter]
-            if str_chunk_num != portion_counter:
-                portion_counter = str_chunk_num
-                abs_stream_pos += portions_len[portion_counter-1]
-                #print hex(abs_stream_pos)
-            str_stream_pos = abs_stream_pos + pos_in_chunk + 4 # header
-            extsst[str_counter] = (pos_in_chunk, str_stream_pos)
-            str_counter += 1
-
-        exsst_str_count_delta = max(8, len(str_placement)*8/0x2000) # maybe smth else?
-        self._rec_data = pack('<H', exsst_str_count_delta)
-        str_counter = 0
-        while str_counter < len(str_placement):
-            self._rec_data += pack('<IHH', extsst[str_counter][1], extsst[str_counter][0], 0)
-            str_counter += exsst_str_count_delta
+    def __init__(self, sst_stream_pos, strings_per_bucket, bucket_placement, portions_len):
+        """
+        :param sst_stream_pos: stream position of the SST record.
+        :param strings_per_bucket: number of strings in a portion.
+        :param bucket_placement: (record number, offset in record data) of
+          the first string of each portion, record 0 is the SST record and
+          the others are its CONTINUE records.
+        :param portions_len: data length of each of these records.
+        """
+        records_pos = []
+        pos = sst_stream_pos
+        for portion_len in portions_len:
+            records_pos.append(pos)
+            pos += 4 + portion_len # header
+
+        rec_data = [pack('<H', strings_per_bucket)]
+        for rec_num, pos_in_rec_data in bucket_placement:
+            pos_in_rec = 4 + pos_in_rec_data # header
+            rec_data.append(pack('<IHH', records_pos[rec_num] + pos_in_rec, pos_in_rec, 0))
+        self._rec_data = b''.join(rec_data)
 
 class DimensionsRecord(BiffRecord):
     """
@@ -1440,6 +1571,57 @@ class RowRecord(BiffRecord):
                                         0x00, 0x00,
                                         options)
 
+class IndexRecord(BiffRecord):
+    """
+    This record follows the BOF record of a worksheet. It points to the
+    DBCELL record of each row block, so readers can find a row without
+    going through all the rows before it.
+
+    Record INDEX, BIFF8:
+
+    Offset  Size    Contents
+    0       4       Not used
+    4       4       Index to first used row
+    8       4       Index to first row of unused tail of sheet (last used row + 1)
+    12      4       Absolute stream position of the DEFCOLWIDTH record
+    16      4nm     Array of nm absolute stream positions to the DBCELL record
+                    of each row block
+    """
+    _REC_ID = 0x020B
+
+    def __init__(self, first_used_row, last_used_row, defcolwidth_pos, dbcell_positions):
+        if first_used_row > last_used_row:
+            # empty worksheet
+            first_used_row = 0
+            last_used_row = -1
+        self._rec_data = pack('<4L%dL' % len(dbcell_positions), 0x00,
+                              first_used_row, last_used_row + 1,
+                              defcolwidth_pos, *dbcell_positions)
+
+class DbCellRecord(BiffRecord):
+    """
+    This record follows the cell records of a row block (the rows with the
+    same row index // 32). It holds the offsets to the block's ROW records
+    and to the first cell record of each of its rows.
+
+    Record DBCELL, BIFF2-BIFF8:
+
+    Offset  Size    Contents
+    0       4       Relative offset to first ROW record in the row block,
+                    from the start of this record
+    4       2nc     Offsets to the first cell record of each of the nc rows.
+                    The first offset is relative to the start of the second
+                    ROW record of the block, the following ones to the first
+                    cell record of the preceding row.
+    """
+    _REC_ID = 0x00D7
+
+    def __init__(self, first_row_offset, cell_offsets):
+        # a row's cells can take more than 64K (long LABEL strings),
+        # its offset is truncated to 16 bits like Excel does
+        self._rec_data = pack('<L%dH' % len(cell_offsets), first_row_offset,
+                              *[offset & 0xFFFF for offset in cell_offsets])
+
 class LabelSSTRecord(BiffRecord):
     """
     This record represents a cell that contains a string. It replaces the
@@ -1451,6 +1633,26 @@ class LabelSSTRecord(BiffRecord):
         self._rec_data = pack('<3HL', row, col, xf_idx, sst_idx)
 
 
+class LabelRecord(BiffRecord):
+    """
+    This record represents a cell that contains a string stored in the
+    record itself instead of the shared string table. Excel writes
+    LABELSST records, but reads LABEL records in BIFF8 files too.
+
+    Record LABEL, BIFF8:
+
+    Offset  Size    Contents
+    0       2       Index to row
+    2       2       Index to column
+    4       2       Index to XF record
+    6       var.    Unicode string, 16-bit string length, at most 255 characters
+    """
+    _REC_ID = 0x0204
+
+    def __init__(self, row, col, xf_idx, label, encoding='ascii'):
+        self._rec_data = pack('<3H', row, col, xf_idx) + upack2(label, encoding)
+
+
 class MergedCellsRecord(BiffRecord):
     """
     This record contains all merged cell ranges of the current sheet.
@@ -1883,7 +2085,7 @@ class DefColWidthRecord(BiffRecord):
     _REC_ID = 0x0055
 
     def __init__(self, def_width):
-        self._rec_data = pack('<H', options, def_width)
+        self._rec_data = pack('<H', def_width)
 
 class HorizontalPageBreaksRecord(BiffRecord):
     """
@@ -1,8 +1,21 @@
 # -*- coding: windows-1252 -*-
 
-from struct import unpack, pack
+from struct import unpack, pack, Struct
 from . import BIFFRecords
-from .compat import xrange
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Packers of the cell records
+_LABELSST = Struct('<5HL')
+_CELL_HEADER = Struct('<5H') # BLANK record, start of LABEL record
+_NUMBER = Struct('<5Hd')
+_RK = Struct('<5Hi')
+_MUL_HEADER = Struct('<4H') # start of MULRK and MULBLANK records
+_MULRK_CELL = Struct('<Hi')
+_UINT16 = Struct('<H')
 
 class StrCell(object):
     __slots__ = ["rowx", "colx", "xf_idx", "sst_idx"]
@@ -15,7 +28,23 @@ class StrCell(object):
 
     def get_biff_data(self):
         # return BIFFRecords.LabelSSTRecord(self.rowx, self.colx, self.xf_idx, self.sst_idx).get()
-        return pack('<5HL', 0x00FD, 10, self.rowx, self.colx, self.xf_idx, self.sst_idx)
+        return _LABELSST.pack(0x00FD, 10, self.rowx, self.colx, self.xf_idx, self.sst_idx)
+
+class LabelCell(object):
+    __slots__ = ["rowx", "colx", "xf_idx", "label"]
+
+    # Maximum number of characters of a LABEL record's string.
+    MAX_LEN = 255
+
+    def __init__(self, rowx, colx, xf_idx, label):
+        # label is the string as encoded by UnicodeUtils.upack2()
+        self.rowx = rowx
+        self.colx = colx
+        self.xf_idx = xf_idx
+        self.label = label
+
+    def get_biff_data(self):
+        return _CELL_HEADER.pack(0x0204, 6 + len(self.label), self.rowx, self.colx, self.xf_idx) + self.label
 
 class BlankCell(object):
     __slots__ = ["rowx", "colx", "xf_idx"]
@@ -27,7 +56,7 @@ class BlankCell(object):
 
     def get_biff_data(self):
         # return BIFFRecords.BlankRecord(self.rowx, self.colx, self.xf_idx).get()
-        return pack('<5H', 0x0201, 6, self.rowx, self.colx, self.xf_idx)
+        return _CELL_HEADER.pack(0x0201, 6, self.rowx, self.colx, self.xf_idx)
 
 class MulBlankCell(object):
     __slots__ = ["rowx", "colx1", "colx2", "xf_idx"]
@@ -52,61 +81,92 @@ class NumberCell(object):
         self.number = float(number)
 
     def get_encoded_data(self):
-        rk_encoded = 0
-        num = self.number
-
-        # The four possible kinds of RK encoding are *not* mutually exclusive.
-        # The 30-bit integer variety picks up the most.
-        # In the code below, the four varieties are checked in descending order
-        # of bangs per buck, or not at all.
-        # SJM 2007-10-01
-
-        if -0x20000000 <= num < 0x20000000: # fits in 30-bit *signed* int
-            inum = int(num)
-            if inum == num: # survives round-trip
-                # print "30-bit integer RK", inum, hex(inum)
-                rk_encoded = 2 | (inum << 2)
-                return 1, rk_encoded
-
-        temp = num * 100
-
-        if -0x20000000 <= temp < 0x20000000:
-            # That was step 1: the coded value will fit in
-            # a 30-bit signed integer.
-            itemp = int(round(temp, 0))
-            # That was step 2: "itemp" is the best candidate coded value.
-            # Now for step 3: simulate the decoding,
-            # to check for round-trip correctness.
-            if itemp / 100.0 == num:
-                # print "30-bit integer RK*100", itemp, hex(itemp)
-                rk_encoded = 3 | (itemp << 2)
-                return 1, rk_encoded
-
-        if 0: # Cost of extra pack+unpack not justified by tiny yield.
-            packed = pack('<d', num)
-            w01, w23 = unpack('<2i', packed)
-            if not w01 and not(w23 & 3):
-                # 34 lsb are 0
-                # print "float RK", w23, hex(w23)
-                return 1, w23
-
-            packed100 = pack('<d', temp)
-            w01, w23 = unpack('<2i', packed100)
-            if not w01 and not(w23 & 3):
-                # 34 lsb are 0
-                # print "float RK*100", w23, hex(w23)
-                return 1, w23 | 1
-
-        #print "Number"
-        #print
-        return 0, pack('<5Hd', 0x0203, 14, self.rowx, self.colx, self.xf_idx, num)
+        rk_encoded = _rk_encode(self.number)
+        if rk_encoded is not None:
+            return 1, rk_encoded
+        return 0, _NUMBER.pack(0x0203, 14, self.rowx, self.colx, self.xf_idx, self.number)
 
     def get_biff_data(self):
         isRK, value = self.get_encoded_data()
         if isRK:
-            return pack('<5Hi', 0x27E, 10, self.rowx, self.colx, self.xf_idx, value)
+            return _RK.pack(0x27E, 10, self.rowx, self.colx, self.xf_idx, value)
         return value # NUMBER record already packed
 
+def _rk_encode(num):
+    # Returns the RK encoded value of num, or None if it can't be RK encoded.
+
+    # The four possible kinds of RK encoding are *not* mutually exclusive.
+    # The 30-bit integer variety picks up the most.
+    # In the code below, the four varieties are checked in descending order
+    # of bangs per buck, or not at all.
+    # SJM 2007-10-01
+
+    if -0x20000000 <= num < 0x20000000: # fits in 30-bit *signed* int
+        inum = int(num)
+        if inum == num: # survives round-trip
+            # print "30-bit integer RK", inum, hex(inum)
+            return 2 | (inum << 2)
+
+    temp = num * 100
+
+    if -0x20000000 <= temp < 0x20000000:
+        # That was step 1: the coded value will fit in
+        # a 30-bit signed integer.
+        itemp = int(round(temp, 0))
+        # That was step 2: "itemp" is the best candidate coded value.
+        # Now for step 3: simulate the decoding,
+        # to check for round-trip correctness.
+        if itemp / 100.0 == num:
+            # print "30-bit integer RK*100", itemp, hex(itemp)
+            return 3 | (itemp << 2)
+
+    if 0: # Cost of extra pack+unpack not justified by tiny yield.
+        packed = pack('<d', num)
+        w01, w23 = unpack('<2i', packed)
+        if not w01 and not(w23 & 3):
+            # 34 lsb are 0
+            # print "float RK", w23, hex(w23)
+            return w23
+
+        packed100 = pack('<d', temp)
+        w01, w23 = unpack('<2i', packed100)
+        if not w01 and not(w23 & 3):
+            # 34 lsb are 0
+            # print "float RK*100", w23, hex(w23)
+            return w23 | 1
+
+    #print "Number"
+    #print
+    return None
+
+# With fewer cells than this the NumPy set-up costs more than it saves.
+NUMPY_MIN_CELLS = 1024
+
+def _rk_encode_array(values, xf_indexes):
+    # NumPy version of _rk_encode() for many numbers at once; values is an
+    # array('d') and xf_indexes an array('H') of the same length. Returns a
+    # list with the RK value of each number (None if it needs a NUMBER
+    # record) and the MULRK cell data of all numbers: XF index and RK
+    # value, 6 bytes each, so a MULRK run is a slice of it.
+    nums = numpy.frombuffer(values, dtype=numpy.float64)
+    with numpy.errstate(invalid='ignore', over='ignore'):
+        fits = (nums >= -0x20000000) & (nums < 0x20000000)
+        inums = numpy.where(fits, nums, 0).astype(numpy.int64)
+        is_int = fits & (inums == nums)
+        temps = nums * 100
+        fits100 = ~is_int & (temps >= -0x20000000) & (temps < 0x20000000)
+        itemps = numpy.where(fits100, numpy.round(temps), 0).astype(numpy.int64)
+        is_int100 = fits100 & (itemps / 100.0 == nums)
+    is_rk = is_int | is_int100
+    rk = numpy.where(is_int, 2 | (inums << 2), 3 | (itemps << 2))
+    rk[~is_rk] = 0
+    cells = numpy.empty(len(nums), dtype=[('xf', '<u2'), ('rk', '<i4')])
+    cells['xf'] = numpy.frombuffer(xf_indexes, dtype=numpy.uint16)
+    cells['rk'] = rk
+    rks = numpy.empty(len(nums), dtype=object)
+    rks[is_rk] = rk[is_rk].astype(object)
+    return rks.tolist(), cells.tobytes()
+
 class BooleanCell(object):
     __slots__ = ["rowx", "colx", "xf_idx", "number"]
 
@@ -169,76 +229,152 @@ class FormulaCell(object):
 
 # module-level function for *internal* use by the Row module
 
+def _reserve(buf, pos, size):
+    # Makes room for size bytes at pos in the bytearray buf.
+    if pos + size > len(buf):
+        buf.extend(bytearray(max(pos + size - len(buf), len(buf))))
+
+# No record of a string, number or blank cell takes more than 18 bytes
+# (NUMBER), so rows reserve 18 bytes per cell up front and only cells of
+# other lengths (LABEL, formulas, ...) reserve more.
+_MAX_CELL_SIZE = 18
+
+# Cell kinds used by the compact (array based) row storage of Row.CompactRow.
+# Each cell is stored as (colx, kind, xf_idx) in an array('H') plus a double
+# holding the SST index, the number, or for CELL_OTHER and CELL_LABEL the
+# index of the cell object or encoded LABEL string in a separate list.
+CELL_STR = 0
+CELL_NUMBER = 1
+CELL_BLANK = 2
+CELL_OTHER = 3
+CELL_LABEL = 4
+
+# kinds of the cell classes packed without calling get_biff_data()
+_CELL_KINDS = {StrCell: CELL_STR, NumberCell: CELL_NUMBER, BlankCell: CELL_BLANK, LabelCell: CELL_LABEL}
+
+def _compact_cells(cell_items):
+    # Puts the (colx, cell) items of a row in the compact row layout, so
+    # both kinds of rows share _pack_compact_cells(). Returns meta, values
+    # and others like Row.CompactRow stores them.
+    meta = []
+    values = []
+    others = []
+    for colx, cell in cell_items:
+        kind = _CELL_KINDS.get(type(cell), CELL_OTHER)
+        meta += (colx, kind, cell.xf_idx)
+        if kind == CELL_NUMBER:
+            values.append(cell.number)
+        elif kind == CELL_STR:
+            values.append(cell.sst_idx)
+        elif kind == CELL_BLANK:
+            values.append(0)
+        else:
+            values.append(len(others))
+            others.append(cell.label if kind == CELL_LABEL else cell)
+    return meta, values, others
+
 def _get_cells_biff_data_mul(rowx, cell_items):
     # Return the BIFF data for all cell records in the row.
     # Adjacent BLANK|RK records are combined into MUL(BLANK|RK) records.
-    pieces = []
-    nitems = len(cell_items)
+    meta, values, others = _compact_cells(cell_items)
+    return _get_compact_cells_biff_data(rowx, meta, values, others)
+
+def _get_compact_cells_biff_data(rowx, meta, values, others):
+    # Returns the BIFF data for all cell records of a row stored as
+    # parallel arrays, see _pack_compact_cells().
+    buf = bytearray()
+    pos = _pack_compact_cells(buf, 0, rowx, meta, values, others)
+    del buf[pos:]
+    return bytes(buf)
+
+def _pack_compact_cells(buf, pos, rowx, meta, values, others, rks=None, mulrk_data=None, offset=0):
+    # Packs the cell records of a row stored as parallel arrays into the
+    # bytearray buf at pos, growing buf as needed, and returns the position
+    # after them. Adjacent BLANK|RK records are combined into MUL(BLANK|RK)
+    # records. rks and mulrk_data (a memoryview) are the results of
+    # _rk_encode_array() for a batch of rows, this row's cells start at
+    # offset in them.
+    nitems = len(values)
+    _reserve(buf, pos, _MAX_CELL_SIZE * nitems)
     i = 0
     while i < nitems:
-        icolx, icell = cell_items[i]
-        if isinstance(icell, NumberCell):
-            isRK, value = icell.get_encoded_data()
-            if not isRK:
-                pieces.append(value) # pre-packed NUMBER record
+        k = 3 * i
+        icolx = meta[k]
+        kind = meta[k + 1]
+        xf_idx = meta[k + 2]
+        if kind == CELL_STR:
+            _LABELSST.pack_into(buf, pos, 0x00FD, 10, rowx, icolx, xf_idx, int(values[i]))
+            pos += 14
+            i += 1
+            continue
+        if kind == CELL_OTHER or kind == CELL_LABEL:
+            if kind == CELL_LABEL:
+                label = others[int(values[i])]
+                _reserve(buf, pos, 10 + len(label) + _MAX_CELL_SIZE * (nitems - i - 1))
+                _CELL_HEADER.pack_into(buf, pos, 0x0204, 6 + len(label), rowx, icolx, xf_idx)
+                buf[pos + 10:pos + 10 + len(label)] = label
+                pos += 10 + len(label)
+            else:
+                cell = others[int(values[i])]
+                if cell is not None:
+                    data = cell.get_biff_data()
+                    buf[pos:pos + len(data)] = data
+                    pos += len(data)
+                    _reserve(buf, pos, _MAX_CELL_SIZE * (nitems - i - 1))
+            i += 1
+            continue
+        if kind == CELL_NUMBER:
+            rk = _rk_encode(values[i]) if rks is None else rks[offset + i]
+            if rk is None:
+                _NUMBER.pack_into(buf, pos, 0x0203, 14, rowx, icolx, xf_idx, values[i])
+                pos += 18
                 i += 1
                 continue
-            muldata = [(value, icell.xf_idx)]
-            target = NumberCell
-        elif isinstance(icell, BlankCell):
-            muldata = [icell.xf_idx]
-            target = BlankCell
+            if mulrk_data is None:
+                _MULRK_CELL.pack_into(buf, pos + 8, xf_idx, rk)
+            cell_size = 6
         else:
-            pieces.append(icell.get_biff_data())
-            i += 1
-            continue
+            _UINT16.pack_into(buf, pos + 8, xf_idx)
+            cell_size = 2
+        # collect the run of cells of the same kind in adjacent columns,
+        # they are packed as MULRK/MULBLANK cells right away
         lastcolx = icolx
-        j = i
-        packed_record = ''
-        for j in xrange(i+1, nitems):
-            jcolx, jcell = cell_items[j]
-            if jcolx != lastcolx + 1:
-                nexti = j
-                break
-            if not isinstance(jcell, target):
-                nexti = j
+        cell_pos = pos + 8 + cell_size
+        j = i + 1
+        while j < nitems:
+            k = 3 * j
+            jcolx = meta[k]
+            if jcolx != lastcolx + 1 or meta[k + 1] != kind:
                 break
-            if target == NumberCell:
-                isRK, value = jcell.get_encoded_data()
-                if not isRK:
-                    packed_record = value
-                    nexti = j + 1
-                    break
-                muldata.append((value, jcell.xf_idx))
+            if kind == CELL_NUMBER:
+                jrk = _rk_encode(values[j]) if rks is None else rks[offset + j]
+                if jrk is None:
+                    break # NUMBER record, written on the next pass
+                if mulrk_data is None:
+                    _MULRK_CELL.pack_into(buf, cell_pos, meta[k + 2], jrk)
             else:
-                muldata.append(jcell.xf_idx)
+                _UINT16.pack_into(buf, cell_pos, meta[k + 2])
+            cell_pos += cell_size
             lastcolx = jcolx
-        else:
-            nexti = j + 1
-        if target == NumberCell:
-            if lastcolx == icolx:
-                # RK record
-                value, xf_idx = muldata[0]
-                pieces.append(pack('<5Hi', 0x027E, 10, rowx, icolx, xf_idx, value))
+            j += 1
+        if lastcolx != icolx:
+            # MULRK or MULBLANK record
+            if kind == CELL_NUMBER:
+                if mulrk_data is not None:
+                    buf[pos + 8:cell_pos] = mulrk_data[6 * (offset + i):6 * (offset + j)]
+                rec_id = 0x00BD
             else:
-                # MULRK record
-                nc = lastcolx - icolx + 1
-                pieces.append(pack('<4H', 0x00BD, 6 * nc + 6, rowx, icolx))
-                pieces.append(b''.join(pack('<Hi', xf_idx, value) for value, xf_idx in muldata))
-                pieces.append(pack('<H', lastcolx))
+                rec_id = 0x00BE
+            _MUL_HEADER.pack_into(buf, pos, rec_id, cell_pos - pos - 2, rowx, icolx)
+            _UINT16.pack_into(buf, cell_pos, lastcolx)
+            pos = cell_pos + 2
+        elif kind == CELL_NUMBER:
+            # RK record
+            _RK.pack_into(buf, pos, 0x027E, 10, rowx, icolx, xf_idx, rk)
+            pos += 14
         else:
-            if lastcolx == icolx:
-                # BLANK record
-                xf_idx = muldata[0]
-                pieces.append(pack('<5H', 0x0201, 6, rowx, icolx, xf_idx))
-            else:
-                # MULBLANK record
-                nc = lastcolx - icolx + 1
-                pieces.append(pack('<4H', 0x00BE, 2 * nc + 6, rowx, icolx))
-                pieces.append(b''.join(pack('<H', xf_idx) for xf_idx in muldata))
-                pieces.append(pack('<H', lastcolx))
-        if packed_record:
-            pieces.append(packed_record)
-        i = nexti
-    return b''.join(pieces)
-
+            # BLANK record
+            _CELL_HEADER.pack_into(buf, pos, 0x0201, 6, rowx, icolx, xf_idx)
+            pos += 10
+        i = j
+    return pos
@@ -15,6 +15,52 @@ from .compat import xrange
 # ...       directory stream
 #
 # NOTE: this layout is "ad hoc". It can be more general. RTFM
+#
+# The workbook stream is passed around as a list of pieces. A piece is
+# either a byte string or a temporary file holding spooled record data
+# (see Worksheet.flush_row_data). Files are copied in chunks when the
+# document is saved, so their contents never have to be held in memory.
+
+STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+
+def _piece_len(piece):
+    if hasattr(piece, 'read'):
+        piece.flush()
+        piece.seek(0, 2)
+        return piece.tell()
+    return len(piece)
+
+def _iter_piece(piece):
+    if not hasattr(piece, 'read'):
+        yield piece
+        return
+    piece.flush()
+    piece.seek(0)
+    try:
+        while True:
+            data = piece.read(STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+    finally:
+        # seek() back to EOF is necessary to avoid a spurious IOError
+        # with Errno 0 if the caller continues on writing rows
+        # and flushing row data after the save().
+        # See https://bugs.python.org/issue3207
+        piece.seek(0, 2)
+
+def stream_len(stream):
+    """
+    Returns the length in bytes of a workbook stream given as a list of
+    pieces.
+    """
+    return sum(_piece_len(piece) for piece in stream)
+
+def join_stream(stream):
+    """
+    Returns a workbook stream given as a list of pieces as one byte string.
+    """
+    return b''.join(data for piece in stream for data in _iter_piece(piece))
 
 class XlsDoc:
     SECTOR_SIZE = 0x0200
@@ -248,9 +294,16 @@ class XlsDoc:
                                         
 
     def save(self, file_name_or_filelike_obj, stream):
+        # stream is the workbook stream, either as a byte string or as a
+        # list of pieces that are written one after the other (so the
+        # whole stream never has to exist as a single object)
+        if isinstance(stream, (bytes, bytearray)):
+            stream = [stream]
+        book_len = stream_len(stream)
+
         # 1. Align stream on 0x1000 boundary (and therefore on sector boundary)
-        padding = b'\x00' * (0x1000 - (len(stream) % 0x1000))
-        self.book_stream_len = len(stream) + len(padding)
+        padding = b'\x00' * (0x1000 - (book_len % 0x1000))
+        self.book_stream_len = book_len + len(padding)
 
         self._build_directory()
         self._build_sat()
@@ -267,14 +320,16 @@ class XlsDoc:
         # This is said to be alleviated by using "w+b" mode instead of "wb".
         # One xlwt user has reported anomalous results at much smaller sizes,
         # The fallback is to write the stream in 4 MB chunks.
-        try:
-            f.write(stream)
-        except IOError as e:
-            if e.errno != 22: # "Invalid argument" i.e. 'stream' is too big
-                raise # some other problem
-            chunk_size = 4 * 1024 * 1024
-            for offset in xrange(0, len(stream), chunk_size):
-                f.write(buffer(stream, offset, chunk_size))
+        for piece in stream:
+            for data in _iter_piece(piece):
+                try:
+                    f.write(data)
+                except IOError as e:
+                    if e.errno != 22: # "Invalid argument" i.e. 'data' is too big
+                        raise # some other problem
+                    view = memoryview(data)
+                    for offset in xrange(0, len(data), STREAM_CHUNK_SIZE):
+                        f.write(view[offset:offset + STREAM_CHUNK_SIZE])
         f.write(padding)
         f.write(self.packed_MSAT_2nd)
         f.write(self.packed_SAT)
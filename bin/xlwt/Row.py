@@ -1,14 +1,23 @@
 # -*- coding: windows-1252 -*-
 
+from array import array
+from bisect import bisect_left
 from decimal import Decimal
+from struct import Struct
 from . import BIFFRecords
 from . import Style
-from .Cell import StrCell, BlankCell, NumberCell, FormulaCell, MulBlankCell, BooleanCell, ErrorCell, \
-    _get_cells_biff_data_mul
+from .Cell import StrCell, LabelCell, BlankCell, NumberCell, FormulaCell, MulBlankCell, BooleanCell, ErrorCell, \
+    _get_cells_biff_data_mul, _compact_cells, _get_compact_cells_biff_data, _pack_compact_cells, _rk_encode_array, NUMPY_MIN_CELLS, \
+    CELL_STR, CELL_NUMBER, CELL_BLANK, CELL_OTHER, CELL_LABEL
+from . import Cell
+from .UnicodeUtils import upack2
 from . import ExcelFormula
 import datetime as dt
 from .Formatting import Font
-from .compat import basestring, xrange, int_types, iteritems
+from .compat import basestring, xrange, int_types
+
+# ROW record, see BIFFRecords.RowRecord
+_ROW = Struct('<8HL')
 
 
 class Row(object):
@@ -17,6 +26,7 @@ class Row(object):
                  "__parent",
                  "__parent_wb",
                  "__cells",
+                 "__colxs",
                  "__min_col_idx",
                  "__max_col_idx",
                  "__xf_index",
@@ -39,6 +49,9 @@ class Row(object):
         self.__parent = parent_sheet
         self.__parent_wb = parent_sheet.get_parent()
         self.__cells = {}
+        # column indexes of the cells in increasing order, None once a
+        # cell was inserted left of another one
+        self.__colxs = []
         self.__min_col_idx = 0
         self.__max_col_idx = 0
         self.__xf_index = 0x0F
@@ -56,12 +69,7 @@ class Row(object):
 
 
     def __adjust_height(self, style):
-        twips = style.font.height
-        points = float(twips)/20.0
-        # Cell height in pixels can be calcuted by following approx. formula:
-        # cell height in pixels = font height in points * 83/50 + 2/5
-        # It works when screen resolution is 96 dpi
-        pix = int(round(points*83.0/50.0 + 2.0/5.0))
+        pix = Style.style_height_in_pixels(style)
         if pix > self.__height_in_pixels:
             self.__height_in_pixels = pix
 
@@ -129,7 +137,7 @@ class Row(object):
         return self.__max_col_idx
 
 
-    def get_row_biff_data(self):
+    def __row_options(self):
         height_options = (self.height & 0x07FFF)
         height_options |= (self.has_default_height & 0x01) << 15
 
@@ -142,20 +150,61 @@ class Row(object):
         options |= (self.__xf_index & 0x0FFF) << 16
         options |= (self.space_above & 1) << 28
         options |= (self.space_below & 1) << 29
+        return height_options, options
 
+    def get_row_biff_data(self):
+        height_options, options = self.__row_options()
         return BIFFRecords.RowRecord(self.__idx, self.__min_col_idx,
             self.__max_col_idx, height_options, options).get()
 
+    def pack_cells_biff_data(self, buf, pos):
+        """
+        Packs the cell records into the bytearray buf at pos, growing buf
+        as needed, and returns the position after them.
+        """
+        meta, values, others = _compact_cells(self.__cell_items())
+        return _pack_compact_cells(buf, pos, self.__idx, meta, values, others)
+
+    def pack_row_biff_data(self, buf, pos):
+        """
+        Packs the ROW record into the bytearray buf at pos, which must
+        have room for its 20 bytes, and returns the position after it.
+        """
+        height_options, options = self.__row_options()
+        _ROW.pack_into(buf, pos, 0x0208, 16, self.__idx, self.__min_col_idx,
+            self.__max_col_idx + 1, height_options, 0x00, 0x00, options)
+        return pos + 20
+
+    def _overwrite_cell(self, col_index, sst_idx):
+        # Called before the cell in col_index is replaced; sst_idx is the
+        # SST index of the old cell's string or None.
+        if not self.__parent._cell_overwrite_ok:
+            msg = "Attempt to overwrite cell: sheetname=%r rowx=%d colx=%d" \
+                % (self.__parent.name, self.__idx, col_index)
+            raise Exception(msg)
+        if sst_idx is not None:
+            self.__parent_wb.del_str(sst_idx)
+
+    def _inline_string_cols(self):
+        # Columns of the sheet whose strings are written as LABEL records,
+        # see Worksheet.set_inline_string_cols().
+        return self.__parent._inline_string_cols
+
+    def _label_cell(self, col, label, xf_index):
+        # Returns a LabelCell for label if it can be written inline.
+        if len(label) <= LabelCell.MAX_LEN:
+            return LabelCell(self.__idx, col, xf_index, upack2(label, self.__parent_wb.encoding))
+        return None
+
     def insert_cell(self, col_index, cell_obj):
         if col_index in self.__cells:
-            if not self.__parent._cell_overwrite_ok:
-                msg = "Attempt to overwrite cell: sheetname=%r rowx=%d colx=%d" \
-                    % (self.__parent.name, self.__idx, col_index)
-                raise Exception(msg)
             prev_cell_obj = self.__cells[col_index]
-            sst_idx = getattr(prev_cell_obj, 'sst_idx', None)
-            if sst_idx is not None:
-                self.__parent_wb.del_str(sst_idx)
+            self._overwrite_cell(col_index, getattr(prev_cell_obj, 'sst_idx', None))
+        elif self.__colxs is not None:
+            if not self.__colxs or col_index > self.__colxs[-1]:
+                self.__colxs.append(col_index)
+            else:
+                self.__colxs = None # sorted when serialised
         self.__cells[col_index] = cell_obj
 
     def insert_mulcells(self, colx1, colx2, cell_obj):
@@ -163,10 +212,15 @@ class Row(object):
         for col_index in xrange(colx1+1, colx2+1):
             self.insert_cell(col_index, None)
 
+    def __cell_items(self):
+        cells = self.__cells
+        colxs = self.__colxs
+        if colxs is None:
+            colxs = sorted(cells)
+        return [(colx, cells[colx]) for colx in colxs if cells[colx] is not None]
+
     def get_cells_biff_data(self):
-        cell_items = [item for item in iteritems(self.__cells) if item[1] is not None]
-        cell_items.sort() # in column order
-        return _get_cells_biff_data_mul(self.__idx, cell_items)
+        return _get_cells_biff_data_mul(self.__idx, self.__cell_items())
         # previously:
         # return ''.join([cell.get_biff_data() for colx, cell in cell_items])
 
@@ -229,11 +283,73 @@ class Row(object):
         self.__adjust_height(style)
         self.__adjust_bound_col_idx(col)
         style_index = self.__parent_wb.add_style(style)
+        self.__write_label(col, label, style, style_index)
+
+    def write_xf(self, col, label, xf_index):
+        # Same as write() but takes the index of a style registered with
+        # Workbook.add_styles(), so no style lookup is done per cell.
+        style, pix = self.__parent_wb.get_registered_xf(xf_index)
+        if pix > self.__height_in_pixels:
+            self.__height_in_pixels = pix
+        self.__adjust_bound_col_idx(col)
+        self.__write_label(col, label, style, xf_index)
+
+    def write_row(self, values, xf_indexes, first_col=0):
+        # Writes a whole row of values, xf_indexes holds one XF index
+        # (see Workbook.add_styles()) per value. Bounds and row height are
+        # checked once for the row instead of once per cell.
+        if not self._prepare_write_row(values, xf_indexes, first_col):
+            return
+        get_registered_xf = self.__parent_wb.get_registered_xf
+        add_str = self.__parent_wb.add_str
+        inline_cols = self.__parent._inline_string_cols
+        rowx = self.__idx
+        cells = self.__cells
+        # cells of a fresh row can't be overwritten, skip the checks in insert_cell
+        fresh = not cells
+        insert_cell = fresh and cells.__setitem__ or self.insert_cell
+        col = first_col
+        for label, xf_index in zip(values, xf_indexes):
+            label_type = type(label)
+            if label_type is float:
+                insert_cell(col, NumberCell(rowx, col, xf_index, label))
+            elif isinstance(label, basestring):
+                if label:
+                    cell = inline_cols and col in inline_cols and self._label_cell(col, label, xf_index)
+                    if not cell:
+                        cell = StrCell(rowx, col, xf_index, add_str(label))
+                    insert_cell(col, cell)
+                else:
+                    insert_cell(col, BlankCell(rowx, col, xf_index))
+            else:
+                self.__write_label(col, label, get_registered_xf(xf_index)[0], xf_index)
+            col += 1
+        if fresh:
+            self.__colxs = list(xrange(first_col, col))
+
+    def _prepare_write_row(self, values, xf_indexes, first_col):
+        # Bounds and row height checks for write_row(), returns the
+        # number of cells to write.
+        ncols = len(values)
+        if ncols == 0:
+            return 0
+        if len(xf_indexes) != ncols:
+            raise ValueError("got %d values but %d XF indexes" % (ncols, len(xf_indexes)))
+        self.__adjust_bound_col_idx(first_col, first_col + ncols - 1)
+        get_registered_xf = self.__parent_wb.get_registered_xf
+        for xf_index in set(xf_indexes):
+            pix = get_registered_xf(xf_index)[1]
+            if pix > self.__height_in_pixels:
+                self.__height_in_pixels = pix
+        return ncols
+
+    def __write_label(self, col, label, style, style_index):
         if isinstance(label, basestring):
             if len(label) > 0:
-                self.insert_cell(col,
-                    StrCell(self.__idx, col, style_index, self.__parent_wb.add_str(label))
-                    )
+                cell = col in self.__parent._inline_string_cols and self._label_cell(col, label, style_index)
+                if not cell:
+                    cell = StrCell(self.__idx, col, style_index, self.__parent_wb.add_str(label))
+                self.insert_cell(col, cell)
             else:
                 self.insert_cell(col, BlankCell(self.__idx, col, style_index))
         elif isinstance(label, bool): # bool is subclass of int; test bool first
@@ -289,5 +405,156 @@ class Row(object):
     write_rich_text = set_cell_rich_text
 
 
+class CompactRow(Row):
+    """
+    A :class:`Row` that doesn't keep one object per cell. String, number
+    and blank cells are stored in two arrays: ``(colx, kind, xf_idx)``
+    triples in an ``array('H')`` and the SST index or number in an
+    ``array('d')``. Inline (LABEL) strings are kept encoded and all other
+    cells as objects on the side.
+    The arrays are serialised directly by :meth:`get_cells_biff_data`.
+
+    Cells are cheapest to add in increasing column order, which is how
+    :meth:`write_row` adds them. Writing to an earlier column works too.
 
+    Used for all sheets of a workbook created with
+    ``Workbook(compact_rows=True)``.
+    """
+    __slots__ = ["_meta", "_values", "_others", "_free_others", "_wb"]
 
+    def __init__(self, rowx, parent_sheet):
+        Row.__init__(self, rowx, parent_sheet)
+        self._meta = array('H')
+        self._values = array('d')
+        self._others = None
+        # indexes of _others slots no cell refers to any more
+        self._free_others = None
+        self._wb = parent_sheet.get_parent()
+
+    def get_cells_count(self):
+        return len(self._values)
+
+    def __store(self, col_index, kind, xf_idx, value):
+        meta = self._meta
+        values = self._values
+        if not values or col_index > meta[-3]:
+            # appending in column order, the usual case
+            meta.extend((col_index, kind, xf_idx))
+            values.append(value)
+            return
+        pos = bisect_left(meta[0::3], col_index)
+        if meta[3*pos] == col_index:
+            sst_idx = None
+            if meta[3*pos+1] == CELL_STR:
+                sst_idx = int(values[pos])
+            elif meta[3*pos+1] == CELL_OTHER:
+                sst_idx = getattr(self._others[int(values[pos])], 'sst_idx', None)
+            self._overwrite_cell(col_index, sst_idx)
+            if meta[3*pos+1] in (CELL_LABEL, CELL_OTHER) and kind not in (CELL_LABEL, CELL_OTHER):
+                # the slot is free for the next LABEL or other cell
+                slot = int(values[pos])
+                self._others[slot] = None
+                if self._free_others is None:
+                    self._free_others = []
+                self._free_others.append(slot)
+            meta[3*pos+1] = kind
+            meta[3*pos+2] = xf_idx
+            values[pos] = value
+        else:
+            meta[3*pos:3*pos] = array('H', (col_index, kind, xf_idx))
+            values.insert(pos, value)
+
+    def __others_slot(self, col_index):
+        # index into _others of the LABEL or other cell in the column, None
+        # if the column is empty or holds a different kind of cell
+        meta = self._meta
+        if not self._values or col_index > meta[-3]:
+            return None
+        pos = bisect_left(meta[0::3], col_index)
+        if meta[3*pos] == col_index and meta[3*pos+1] in (CELL_LABEL, CELL_OTHER):
+            return int(self._values[pos])
+        return None
+
+    def __store_other(self, col_index, kind, xf_idx, obj):
+        # a column that is written again keeps its slot in _others and
+        # freed slots are used before the list grows, so rewritten rows
+        # don't grow
+        if self._others is None:
+            self._others = []
+        slot = self.__others_slot(col_index)
+        if slot is not None:
+            self.__store(col_index, kind, xf_idx, slot)
+        elif self._free_others:
+            slot = self._free_others[-1]
+            self.__store(col_index, kind, xf_idx, slot)
+            self._free_others.pop()
+        else:
+            slot = len(self._others)
+            self.__store(col_index, kind, xf_idx, slot)
+            self._others.append(None)
+        self._others[slot] = obj
+
+    def insert_cell(self, col_index, cell_obj):
+        cell_type = type(cell_obj)
+        if cell_type is StrCell:
+            self.__store(col_index, CELL_STR, cell_obj.xf_idx, cell_obj.sst_idx)
+        elif cell_type is NumberCell:
+            self.__store(col_index, CELL_NUMBER, cell_obj.xf_idx, cell_obj.number)
+        elif cell_type is BlankCell:
+            self.__store(col_index, CELL_BLANK, cell_obj.xf_idx, 0)
+        elif cell_type is LabelCell:
+            self.__store_other(col_index, CELL_LABEL, cell_obj.xf_idx, cell_obj.label)
+        else:
+            self.__store_other(col_index, CELL_OTHER, 0, cell_obj)
+
+    def write_row(self, values, xf_indexes, first_col=0):
+        if not self._prepare_write_row(values, xf_indexes, first_col):
+            return
+        add_str = self._wb.add_str
+        inline_cols = self._inline_string_cols()
+        store = self.__store
+        col = first_col
+        for label, xf_index in zip(values, xf_indexes):
+            label_type = type(label)
+            if label_type is float:
+                store(col, CELL_NUMBER, xf_index, label)
+            elif isinstance(label, basestring):
+                if inline_cols and col in inline_cols and 0 < len(label) <= LabelCell.MAX_LEN:
+                    self.insert_cell(col, self._label_cell(col, label, xf_index))
+                elif label:
+                    store(col, CELL_STR, xf_index, add_str(label))
+                else:
+                    store(col, CELL_BLANK, xf_index, 0)
+            else:
+                self.write_xf(col, label, xf_index)
+            col += 1
+
+    def get_cells_biff_data(self):
+        return _get_compact_cells_biff_data(self.get_index(), self._meta, self._values, self._others)
+
+    def pack_cells_biff_data(self, buf, pos, rks=None, mulrk_data=None, offset=0):
+        """
+        Same as :meth:`Row.pack_cells_biff_data`. rks and mulrk_data are
+        the result of :meth:`rk_encode_rows` for a list of rows and offset
+        is the number of cells of the rows before this one in that list.
+        """
+        return _pack_compact_cells(buf, pos, self.get_index(), self._meta, self._values,
+                                   self._others, rks, mulrk_data, offset)
+
+    @staticmethod
+    def rk_encode_rows(rows):
+        """
+        RK encodes all numbers of the rows in one go if NumPy is installed
+        (see :func:`Cell._rk_encode_array`), returns ``(None, None)``
+        otherwise or if there are too few cells to be worth it.
+        """
+        ncells = sum(len(row._values) for row in rows)
+        if Cell.numpy is None or ncells < NUMPY_MIN_CELLS:
+            return None, None
+        values = array('d')
+        meta = array('H')
+        for row in rows:
+            values.extend(row._values)
+            meta.extend(row._meta)
+        rks, mulrk_data = _rk_encode_array(values, meta[2::3])
+        return rks, memoryview(mulrk_data)
@@ -0,0 +1,116 @@
+'''
+A string to integer mapping that is kept in temporary files instead of
+memory. It is used by the shared string table for the strings added after
+its memory limit was reached (see ``Workbook(sst_memory_limit=...)``).
+
+The strings are appended UTF-8 encoded to a data file. An open addressing
+hash table, memory mapped from a second file, holds one slot per string:
+
+Offset  Size    Contents
+0       8       hash() of the string
+8       8       Position of the string in the data file + 1, 0 = free slot
+16      4       Value
+
+The table is doubled (and rebuilt) when it gets half full.
+'''
+
+import mmap
+import tempfile
+from struct import Struct
+
+_SLOT = Struct('<qQI')
+_LEN = Struct('<I')
+
+def _encode(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+class DiskStringIndex(object):
+
+    def __init__(self, capacity=1 << 16):
+        self._count = 0
+        self._data = tempfile.TemporaryFile()
+        self._data_len = 0
+        self._table_file = None
+        self._table = None
+        self._mask = 0
+        self.__new_table(capacity)
+
+    def __len__(self):
+        return self._count
+
+    def __new_table(self, capacity):
+        table_file = tempfile.TemporaryFile()
+        table_file.truncate(capacity * _SLOT.size)
+        table = mmap.mmap(table_file.fileno(), capacity * _SLOT.size)
+        old_table, old_table_file = self._table, self._table_file
+        self._table, self._table_file = table, table_file
+        self._mask = capacity - 1
+        if old_table is not None:
+            # rehash, the strings stay where they are in the data file
+            for offset in range(0, len(old_table), _SLOT.size):
+                slot = _SLOT.unpack_from(old_table, offset)
+                if slot[1]:
+                    i = slot[0] & self._mask
+                    while _SLOT.unpack_from(table, i * _SLOT.size)[1]:
+                        i = (i + 1) & self._mask
+                    _SLOT.pack_into(table, i * _SLOT.size, *slot)
+            old_table.close()
+            old_table_file.close()
+
+    def __read(self, pos):
+        self._data.seek(pos)
+        length, = _LEN.unpack(self._data.read(_LEN.size))
+        return self._data.read(length)
+
+    def __append(self, data):
+        pos = self._data_len
+        self._data.seek(pos)
+        self._data.write(_LEN.pack(len(data)))
+        self._data.write(data)
+        self._data_len += _LEN.size + len(data)
+        return pos
+
+    def get(self, s, default=None):
+        h = hash(s)
+        data = None
+        table = self._table
+        i = h & self._mask
+        while True:
+            slot_h, slot_pos, slot_value = _SLOT.unpack_from(table, i * _SLOT.size)
+            if not slot_pos:
+                return default
+            if slot_h == h:
+                if data is None:
+                    data = _encode(s)
+                if self.__read(slot_pos - 1) == data:
+                    return slot_value
+            i = (i + 1) & self._mask
+
+    def setdefault(self, s, value):
+        """
+        Returns the value of s, after adding s with the given value if it
+        is not in the index yet.
+        """
+        h = hash(s)
+        data = _encode(s)
+        table = self._table
+        i = h & self._mask
+        while True:
+            slot_h, slot_pos, slot_value = _SLOT.unpack_from(table, i * _SLOT.size)
+            if not slot_pos:
+                break
+            if slot_h == h and self.__read(slot_pos - 1) == data:
+                return slot_value
+            i = (i + 1) & self._mask
+        _SLOT.pack_into(table, i * _SLOT.size, h, self.__append(data) + 1, value)
+        self._count += 1
+        if self._count * 2 > self._mask + 1:
+            self.__new_table((self._mask + 1) * 2)
+        return value
+
+    def close(self):
+        self._table.close()
+        self._table_file.close()
+        self._data.close()
@@ -19,6 +19,14 @@ class XFStyle(object):
 
 default_style = XFStyle()
 
+def style_height_in_pixels(style):
+    twips = style.font.height
+    points = float(twips)/20.0
+    # Cell height in pixels can be calcuted by following approx. formula:
+    # cell height in pixels = font height in points * 83/50 + 2/5
+    # It works when screen resolution is 96 dpi
+    return int(round(points*83.0/50.0 + 2.0/5.0))
+
 class StyleCollection(object):
     _std_num_fmt_list = [
             'general',
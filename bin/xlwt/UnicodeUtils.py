@@ -39,7 +39,7 @@ var.     ln or
 [var.]   sz     (optional, only if phonetic=1) Asian Phonetic Settings Block 
 '''
 
-from .compat import unicode, unicode_type
+from .compat import unicode, unicode_type, accumulate
 from struct import pack
 
 def upack2(s, encoding='ascii'):
@@ -70,6 +70,34 @@ def upack2(s, encoding='ascii'):
         # We need n_items == 2 in this case.
     return pack('<HB', n_items, flag) + encs
 
+# upack2() headers (character count, compressed flag) of short latin-1
+# strings, as latin-1 text so they can be encoded along with the strings
+_LATIN1_HEADERS = [u'%c%c\x00' % (n & 0xFF, n >> 8) for n in range(1024)]
+
+def upack2_many(strings, encoding='ascii'):
+    """
+    Same as ``b''.join([upack2(s, encoding) for s in strings])``, also
+    returns the list of offsets where the data of each string ends.
+
+    If all strings are latin-1 text, the headers are interleaved with the
+    strings and the lot is encoded with a single join and encode call,
+    instead of packing and concatenating every string on its own.
+    """
+    lens = [len(s) for s in strings]
+    if lens and max(lens) < len(_LATIN1_HEADERS):
+        parts = [None] * (2 * len(strings))
+        parts[0::2] = [_LATIN1_HEADERS[n] for n in lens]
+        parts[1::2] = strings
+        try:
+            data = u''.join(parts).encode('latin1')
+        except (UnicodeError, TypeError):
+            # wider characters or byte strings, see upack2()
+            data = None
+        if data is not None:
+            return data, list(accumulate(3 + n for n in lens))
+    encoded = [upack2(s, encoding) for s in strings]
+    return b''.join(encoded), list(accumulate(len(u_str) for u_str in encoded))
+
 def upack2rt(rt, encoding='ascii'):
     us = u''
     fr = b''
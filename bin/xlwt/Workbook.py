@@ -38,10 +38,35 @@
 #       ExtSST
 #       EOF
 
+import os
+import tempfile
 from . import BIFFRecords
+from . import CompoundDoc
 from . import Style
 from .compat import unicode_type, int_types, basestring
 
+try:
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+    # the workers get the sheets by forking, nothing is pickled
+    _fork_context = multiprocessing.get_context('fork')
+except (ImportError, AttributeError, ValueError):
+    _fork_context = None
+
+# the sheets of the workbook being saved, for the forked workers
+_forked_sheets = None
+
+def _sheet_row_blocks(sheetx):
+    # Runs in a worker process, see Workbook.__sheets_row_blocks().
+    # Big results are handed back in a temporary file instead of through
+    # the pipe, the file's path is returned instead of the bytes.
+    data, dbcell_offsets = _forked_sheets[sheetx].get_row_blocks()
+    if len(data) > CompoundDoc.STREAM_CHUNK_SIZE:
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(data)
+        data = f.name
+    return data, dbcell_offsets
+
 class Workbook(object):
     """
     This is a class representing a workbook and all its contents. When creating
@@ -52,8 +77,14 @@ class Workbook(object):
     #################################################################
     ## Constructor
     #################################################################
-    def __init__(self, encoding='ascii', style_compression=0):
+    def __init__(self, encoding='ascii', style_compression=0, compact_rows=False,
+                 sst_memory_limit=0, workers=0):
         self.encoding = encoding
+        # use Row.CompactRow (array based cell storage) for new sheets
+        self.compact_rows = compact_rows
+        # processes serialising the sheets' rows in parallel when saving,
+        # 0 or 1 serialises them in this process
+        self.workers = workers
         self.__owner = 'None'
         self.__country_code = None # 0x07 is Russia :-)
         self.__wnd_protect = 0
@@ -79,11 +110,17 @@ class Workbook(object):
         self.__tabs_visible = 1
 
         self.__styles = Style.StyleCollection(style_compression)
+        self.__registered_xfs = {}
 
         self.__dates_1904 = 0
         self.__use_cell_values = 1
 
-        self.__sst = BIFFRecords.SharedStringTable(self.encoding)
+        # bytes of shared strings kept in memory before the table switches
+        # to temporary files, 0 means no limit
+        self.__sst = BIFFRecords.SharedStringTable(self.encoding, sst_memory_limit)
+        # temporary files with the rows serialised by the workers, open
+        # until the stream was written
+        self.__row_block_files = []
 
         self.__worksheets = []
         self.__worksheet_idx_from_name = {}
@@ -323,6 +360,32 @@ class Workbook(object):
     def add_style(self, style):
         return self.__styles.add(style)
     
+    def add_styles(self, styles):
+        """
+        This method is used to register a fixed set of styles up front.
+
+        :param styles:
+          A sequence of :class:`~xlwt.Style.XFStyle` objects.
+
+        :return:
+          A list with the XF index of each style, in the same order. These
+          can be passed to :meth:`~xlwt.Worksheet.Worksheet.write_xf`, which
+          skips the per cell style lookup done by
+          :meth:`~xlwt.Worksheet.Worksheet.write`.
+        """
+        xf_indexes = []
+        for style in styles:
+            xf_index = self.__styles.add(style)
+            self.__registered_xfs[xf_index] = (style, Style.style_height_in_pixels(style))
+            xf_indexes.append(xf_index)
+        return xf_indexes
+
+    def get_registered_xf(self, xf_index):
+        try:
+            return self.__registered_xfs[xf_index]
+        except KeyError:
+            raise Exception("XF index %r was not registered with add_styles()" % xf_index)
+
     def add_font(self, font):
         return self.__styles.add_font(font)
 
@@ -587,13 +650,7 @@ class Workbook(object):
         # WORKSHEET0
         # WORKSHEET1
         # WORKSHEET2
-        boundsheets_len = 0
-        for sheet in self.__worksheets:
-            boundsheets_len += len(BIFFRecords.BoundSheetRecord(
-                0x00, sheet.visibility, sheet.name, self.encoding
-                ).get())
-
-        start = data_len_before + boundsheets_len + data_len_after
+        start = data_len_before + self.__boundsheets_len() + data_len_after
 
         result = b''
         for sheet_biff_len,  sheet in zip(sheet_biff_lens, self.__worksheets):
@@ -603,6 +660,14 @@ class Workbook(object):
             start += sheet_biff_len
         return result
 
+    def __boundsheets_len(self):
+        boundsheets_len = 0
+        for sheet in self.__worksheets:
+            boundsheets_len += len(BIFFRecords.BoundSheetRecord(
+                0x00, sheet.visibility, sheet.name, self.encoding
+                ).get())
+        return boundsheets_len
+
     def __all_links_rec(self):
         pieces = []
         temp = [(idx, tag) for tag, idx in self._supbook_xref.items()]
@@ -633,64 +698,115 @@ class Workbook(object):
         return b''.join(pieces)
 
     def __sst_rec(self):
-        return self.__sst.get_biff_record()
+        return self.__sst.get_biff_buffers()
 
     def __ext_sst_rec(self, abs_stream_pos):
-        return b''
-        #return BIFFRecords.ExtSSTRecord(abs_stream_pos, self.sst_record.str_placement,
-        #self.sst_record.portions_len).get()
+        return self.__sst.get_ext_sst_record(abs_stream_pos)
 
-    def get_biff_data(self):
-        before = b''
-        before += self.__bof_rec()
-        before += self.__intf_hdr_rec()
-        before += self.__intf_mms_rec()
-        before += self.__intf_end_rec()
-        before += self.__write_access_rec()
-        before += self.__codepage_rec()
-        before += self.__dsf_rec()
-        before += self.__tabid_rec()
-        before += self.__fngroupcount_rec()
-        before += self.__wnd_protect_rec()
-        before += self.__protect_rec()
-        before += self.__obj_protect_rec()
-        before += self.__password_rec()
-        before += self.__prot4rev_rec()
-        before += self.__prot4rev_pass_rec()
-        before += self.__backup_rec()
-        before += self.__hide_obj_rec()
-        before += self.__window1_rec()
-        before += self.__datemode_rec()
-        before += self.__precision_rec()
-        before += self.__refresh_all_rec()
-        before += self.__bookbool_rec()
-        before += self.__all_fonts_num_formats_xf_styles_rec()
-        before += self.__palette_rec()
-        before += self.__useselfs_rec()
+    def get_biff_buffers(self):
+        """
+        Returns the BIFF stream of the workbook as a list of byte strings
+        and, for sheets with flushed rows or rows serialised by
+        :attr:`workers`, the temporary files holding those rows. The stream
+        is the concatenation of the list, which is never built: :meth:`save`
+        writes the pieces out one after the other and closes the workers'
+        files afterwards.
+        """
+        before = [
+            self.__bof_rec(),
+            self.__intf_hdr_rec(),
+            self.__intf_mms_rec(),
+            self.__intf_end_rec(),
+            self.__write_access_rec(),
+            self.__codepage_rec(),
+            self.__dsf_rec(),
+            self.__tabid_rec(),
+            self.__fngroupcount_rec(),
+            self.__wnd_protect_rec(),
+            self.__protect_rec(),
+            self.__obj_protect_rec(),
+            self.__password_rec(),
+            self.__prot4rev_rec(),
+            self.__prot4rev_pass_rec(),
+            self.__backup_rec(),
+            self.__hide_obj_rec(),
+            self.__window1_rec(),
+            self.__datemode_rec(),
+            self.__precision_rec(),
+            self.__refresh_all_rec(),
+            self.__bookbool_rec(),
+            self.__all_fonts_num_formats_xf_styles_rec(),
+            self.__palette_rec(),
+            self.__useselfs_rec(),
+            ]
+        before_len = sum(len(data) for data in before)
 
         country            = self.__country_rec()
         all_links          = self.__all_links_rec()
 
         shared_str_table   = self.__sst_rec()
-        after = country + all_links + shared_str_table
+        after_len = len(country) + len(all_links) + CompoundDoc.stream_len(shared_str_table)
 
         ext_sst = self.__ext_sst_rec(0) # need fake cause we need calc stream pos
         eof = self.__eof_rec()
 
         self.__worksheets[self.__active_sheet].selected = True
-        sheets = b''
+        sheets = []
         sheet_biff_lens = []
-        for sheet in self.__worksheets:
-            data = sheet.get_biff_data()
-            sheets += data
-            sheet_biff_lens.append(len(data))
+        stream_pos = before_len + self.__boundsheets_len() + after_len + len(ext_sst) + len(eof)
+        for sheet, row_blocks in zip(self.__worksheets, self.__sheets_row_blocks()):
+            data = sheet.get_biff_buffers(stream_pos, row_blocks)
+            sheets.extend(data)
+            sheet_biff_lens.append(CompoundDoc.stream_len(data))
+            stream_pos += sheet_biff_lens[-1]
 
-        bundlesheets = self.__boundsheets_rec(len(before), len(after)+len(ext_sst)+len(eof), sheet_biff_lens)
+        bundlesheets = self.__boundsheets_rec(before_len, after_len+len(ext_sst)+len(eof), sheet_biff_lens)
 
-        sst_stream_pos = len(before) + len(bundlesheets) + len(country)  + len(all_links)
+        sst_stream_pos = before_len + len(bundlesheets) + len(country)  + len(all_links)
         ext_sst = self.__ext_sst_rec(sst_stream_pos)
 
-        return before + bundlesheets + after + ext_sst + eof + sheets
+        before.extend([bundlesheets, country, all_links])
+        before.extend(shared_str_table)
+        before.extend([ext_sst, eof])
+        before.extend(sheets)
+        return before
+
+    def __sheets_row_blocks(self):
+        # Worksheet.get_row_blocks() of every sheet, done by self.workers
+        # processes if there is more than one sheet and processes can be
+        # forked. Otherwise the sheets serialise their rows themselves.
+        global _forked_sheets
+        sheets = self.__worksheets
+        if self.workers < 2 or len(sheets) < 2 or _fork_context is None:
+            return [None] * len(sheets)
+        _forked_sheets = sheets
+        try:
+            with ProcessPoolExecutor(min(self.workers, len(sheets)), mp_context=_fork_context) as executor:
+                results = list(executor.map(_sheet_row_blocks, range(len(sheets))))
+        finally:
+            _forked_sheets = None
+        row_blocks = []
+        for data, dbcell_offsets in results:
+            if not isinstance(data, bytes):
+                # temporary file written by the worker, it is deleted
+                # right away and goes away when closed
+                path = data
+                data = open(path, 'rb')
+                os.unlink(path)
+                self.__row_block_files.append(data)
+            row_blocks.append((data, dbcell_offsets))
+        return row_blocks
+
+    def __close_row_block_files(self):
+        files, self.__row_block_files = self.__row_block_files, []
+        for f in files:
+            f.close()
+
+    def get_biff_data(self):
+        try:
+            return CompoundDoc.join_stream(self.get_biff_buffers())
+        finally:
+            self.__close_row_block_files()
 
     def save(self, filename_or_stream):
         """
@@ -704,9 +820,10 @@ class Workbook(object):
           a :class:`~io.StringIO`, in which case the data for the excel
           file is written to the stream.
         """
-        from . import CompoundDoc
-
         doc = CompoundDoc.XlsDoc()
-        doc.save(filename_or_stream, self.get_biff_data())
+        try:
+            doc.save(filename_or_stream, self.get_biff_buffers())
+        finally:
+            self.__close_row_block_files()
 
 
@@ -34,10 +34,12 @@
 
 from . import BIFFRecords
 from . import Bitmap
+from . import CompoundDoc
 from . import Style
-from .Row import Row
+from .Row import Row, CompactRow
+from .Cell import _reserve
 from .Column import Column
-from .compat import unicode, itervalues
+from .compat import unicode
 import tempfile
 
 class Worksheet(object):
@@ -58,11 +60,16 @@ class Worksheet(object):
     #################################################################
     def __init__(self, sheetname, parent_book, cell_overwrite_ok=False):
         self.Row = Row
+        if getattr(parent_book, 'compact_rows', False):
+            self.Row = CompactRow
         self.Column = Column
 
         self.__name = sheetname
         self.__parent = parent_book
         self._cell_overwrite_ok = cell_overwrite_ok
+        # columns whose strings are written as LABEL records instead of
+        # going through the shared string table
+        self._inline_string_cols = frozenset()
 
         self.__rows = {}
         self.__cols = {}
@@ -201,6 +208,9 @@ class Worksheet(object):
         self.first_used_col = 255
         self.row_tempfile = None
         self.__flushed_rows = {}
+        # offsets of the DBCELL records in row_tempfile and its length
+        self.__flushed_dbcells = []
+        self.__flushed_len = 0
         self.__row_visible_levels = 0
 
     #################################################################
@@ -270,6 +280,22 @@ class Worksheet(object):
 
     show_grid = property(get_show_grid, set_show_grid)
 
+    def set_inline_string_cols(self, colxs):
+        """
+        Strings written to these columns from now on are stored in the cell
+        records (LABEL) instead of the workbook's shared string table
+        (LABELSST). This saves the string table lookup and entry for
+        columns where (almost) every value is different, but repeats each
+        value in full. Strings of more than 255 characters always go to the
+        shared string table.
+        """
+        self._inline_string_cols = frozenset(colxs)
+
+    def get_inline_string_cols(self):
+        return self._inline_string_cols
+
+    inline_string_cols = property(get_inline_string_cols, set_inline_string_cols)
+
     #################################################################
 
     def set_show_headers(self, value):
@@ -1087,6 +1113,47 @@ class Worksheet(object):
         """
         self.row(r).write(c, label, style)
 
+    def write_xf(self, r, c, label, xf_index):
+        """
+        Same as :meth:`write`, but the style is given as an XF index
+        returned by :meth:`~xlwt.Workbook.Workbook.add_styles`.
+        """
+        self.row(r).write_xf(c, label, xf_index)
+
+    def write_row(self, r, values, xf_indexes, first_col=0):
+        """
+        This method is used to write a whole row of cells at once.
+
+        :param r:
+           The zero-relative number of the row to write.
+
+        :param values:
+           A sequence of data values, see :meth:`write`.
+
+        :param xf_indexes:
+           A sequence with one XF index per value, as returned by
+           :meth:`~xlwt.Workbook.Workbook.add_styles`.
+
+        :param first_col:
+           The zero-relative column of the first value.
+        """
+        self.row(r).write_row(values, xf_indexes, first_col)
+
+    def write_rows(self, start_row, rows):
+        """
+        This method is used to write rows from an iterable of
+        ``(values, xf_indexes)`` pairs, see :meth:`write_row`, starting at
+        row ``start_row``.
+
+        :return:
+           The number of the row after the last row written.
+        """
+        r = start_row
+        for values, xf_indexes in rows:
+            self.row(r).write_row(values, xf_indexes)
+            r += 1
+        return r
+
     def write_rich_text(self, r, c, rich_text_list, style=Style.default_style):
         self.row(r).set_cell_rich_text(c, rich_text_list, style)
 
@@ -1212,6 +1279,10 @@ class Worksheet(object):
             result += self.__cols[col].get_biff_record()
         return result
 
+    def __defcolwidth_rec(self):
+        # Excel's default, only written for the INDEX record to point to
+        return BIFFRecords.DefColWidthRecord(8).get()
+
     def __dimensions_rec(self):
         return BIFFRecords.DimensionsRecord(
             self.first_used_row, self.last_used_row,
@@ -1305,12 +1376,49 @@ class Worksheet(object):
 
         return result
 
-    def __row_blocks_rec(self):
-        result = []
-        for row in itervalues(self.__rows):
-            result.append(row.get_row_biff_data())
-            result.append(row.get_cells_biff_data())
-        return b''.join(result)
+    def __sorted_rows(self):
+        rows = self.__rows
+        return [rows[rowx] for rowx in sorted(rows)]
+
+    def __row_blocks_rec(self, rows):
+        # Packs the rows (sorted by index) in blocks of the rows with the
+        # same index // 32: the ROW records of the block, the cell records
+        # of its rows and a DBCELL record pointing back to both.
+        # Returns the data and the offsets of the DBCELL records in it.
+        compact = self.Row is CompactRow
+        if compact:
+            rks, mulrk_data = CompactRow.rk_encode_rows(rows)
+        buf = bytearray(24 * len(rows) + 18 * sum(row.get_cells_count() for row in rows))
+        dbcell_offsets = []
+        pos = 0
+        offset = 0
+        i = 0
+        while i < len(rows):
+            blockx = rows[i].get_index() >> 5
+            j = i + 1
+            while j < len(rows) and rows[j].get_index() >> 5 == blockx:
+                j += 1
+            block_pos = pos
+            _reserve(buf, pos, 20 * (j - i))
+            for row in rows[i:j]:
+                pos = row.pack_row_biff_data(buf, pos)
+            cell_offsets = []
+            cells_pos = block_pos + 20 # start of the second ROW record
+            for row in rows[i:j]:
+                cell_offsets.append(pos - cells_pos)
+                cells_pos = pos
+                if compact:
+                    pos = row.pack_cells_biff_data(buf, pos, rks, mulrk_data, offset)
+                    offset += row.get_cells_count()
+                else:
+                    pos = row.pack_cells_biff_data(buf, pos)
+            dbcell = BIFFRecords.DbCellRecord(pos - block_pos, cell_offsets).get()
+            buf[pos:pos + len(dbcell)] = dbcell
+            dbcell_offsets.append(pos)
+            pos += len(dbcell)
+            i = j
+        del buf[pos:]
+        return bytes(buf), dbcell_offsets
 
     def __merged_rec(self):
         return BIFFRecords.MergedCellsRecord(self.__merged_ranges).get()
@@ -1377,44 +1485,90 @@ class Worksheet(object):
         result += BIFFRecords.PasswordRecord(self.__password).get()
         return result
 
-    def get_biff_data(self):
-        result = [
-            self.__bof_rec(),
+    def get_row_blocks(self):
+        """
+        Serialises the rows that were not flushed, which is most of the
+        work of :meth:`get_biff_buffers`. Returns the data and the offsets
+        of the DBCELL records in it.
+        """
+        return self.__row_blocks_rec(self.__sorted_rows())
+
+    def get_biff_buffers(self, stream_pos=0, row_blocks=None):
+        """
+        Returns the BIFF data of the sheet as a list of byte strings and
+        the temporary files of the rows, if any.
+
+        :param stream_pos:
+          Position of the sheet in the workbook stream, the INDEX record
+          holds absolute stream positions.
+
+        :param row_blocks:
+          The result of :meth:`get_row_blocks` if that was done already,
+          the data can also be a file.
+        """
+        if row_blocks is None:
+            row_blocks = self.get_row_blocks()
+        row_blocks, dbcell_offsets = row_blocks
+        dbcell_offsets = self.__flushed_dbcells + [self.__flushed_len + offset for offset in dbcell_offsets]
+        bof = self.__bof_rec()
+        before_defcolwidth = [
             self.__calc_settings_rec(),
             self.__guts_rec(),
             self.__defaultrowheight_rec(),
             self.__wsbool_rec(),
+            ]
+        before_rows = [
+            self.__defcolwidth_rec(),
             self.__colinfo_rec(),
             self.__dimensions_rec(),
             self.__print_settings_rec(),
             self.__protection_rec(),
             ]
+        index_len = len(BIFFRecords.IndexRecord(0, 0, 0, dbcell_offsets).get())
+        defcolwidth_pos = stream_pos + len(bof) + index_len + sum(len(data) for data in before_defcolwidth)
+        rows_pos = defcolwidth_pos + sum(len(data) for data in before_rows)
+        index = BIFFRecords.IndexRecord(self.first_used_row, self.last_used_row, defcolwidth_pos,
+                                        [rows_pos + offset for offset in dbcell_offsets]).get()
+        result = [bof, index] + before_defcolwidth + before_rows
         if self.row_tempfile:
-            self.row_tempfile.flush()
-            self.row_tempfile.seek(0)
-            result.append(self.row_tempfile.read())
-            self.row_tempfile.seek(0, 2) # to EOF
-            # Above seek() is necessary to avoid a spurious IOError
-            # with Errno 0 if the caller continues on writing rows
-            # and flushing row data after the save().
-            # See https://bugs.python.org/issue3207
+            # flushed rows stay on disk, they are copied from the temp
+            # file when the workbook is saved
+            result.append(self.row_tempfile)
         result.extend([
-            self.__row_blocks_rec(),
+            row_blocks,
             self.__merged_rec(),
             self.__bitmaps_rec(),
             self.__window2_rec(),
             self.__panes_rec(),
             self.__eof_rec(),
             ])
-        return b''.join(result)
+        return result
+
+    def get_biff_data(self):
+        return CompoundDoc.join_stream(self.get_biff_buffers())
 
     def flush_row_data(self):
+        # The rows of the last row block stay in memory, the rows written
+        # next usually belong to it.
+        rows = self.__sorted_rows()
+        if not rows:
+            return
+        last_blockx = rows[-1].get_index() >> 5
+        nflush = len(rows)
+        while nflush and rows[nflush - 1].get_index() >> 5 == last_blockx:
+            nflush -= 1
+        if not nflush:
+            return
         if self.row_tempfile is None:
             self.row_tempfile = tempfile.TemporaryFile()
-        self.row_tempfile.write(self.__row_blocks_rec())
-        for rowx in self.__rows:
-            self.__flushed_rows[rowx] = 1
+        data, dbcell_offsets = self.__row_blocks_rec(rows[:nflush])
+        self.row_tempfile.write(data)
+        self.__flushed_dbcells.extend(self.__flushed_len + offset for offset in dbcell_offsets)
+        self.__flushed_len += len(data)
         self.__update_row_visible_levels()
-        self.__rows = {}
+        for row in rows[:nflush]:
+            rowx = row.get_index()
+            self.__flushed_rows[rowx] = 1
+            del self.__rows[rowx]
 
 
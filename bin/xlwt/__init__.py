@@ -2,7 +2,7 @@ __VERSION__ = '1.3.0'
 
 from .Workbook import Workbook
 from .Worksheet import Worksheet
-from .Row import Row
+from .Row import Row, CompactRow
 from .Column import Column
 from .Formatting import Font, Alignment, Borders, Pattern, Protection
 from .Style import XFStyle, easyxf, easyfont, add_palette_colour
@@ -14,6 +14,8 @@ if PY3:
         return iter(d.items())
     def itervalues(d):
         return iter(d.values())
+
+    from itertools import accumulate
 else:
     # Python 2
     unicode = unicode_type = unicode
@@ -26,3 +28,9 @@ else:
         return d.iteritems()
     def itervalues(d):
         return d.itervalues()
+
+    def accumulate(iterable):
+        total = 0
+        for x in iterable:
+            total += x
+            yield total
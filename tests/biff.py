@@ -0,0 +1,25 @@
+"""Walks the BIFF records of a saved .xls independently of xlwt."""
+import os
+import struct
+
+from xlrd import compdoc
+
+
+def workbook_stream(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(os.devnull, 'w') as logfile:
+        return compdoc.CompDoc(data, logfile=logfile).get_named_stream('Workbook')
+
+
+def records(stream):
+    """Returns [(stream position, record id, record data)] of the stream."""
+    recs = []
+    pos = 0
+    while pos + 4 <= len(stream):
+        rid, length = struct.unpack_from('<HH', stream, pos)
+        if rid == 0 and length == 0:
+            break
+        recs.append((pos, rid, stream[pos + 4:pos + 4 + length]))
+        pos += 4 + length
+    return recs
@@ -0,0 +1,5 @@
+# the app's modules (the bundled xlwt included) live in bin/
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin'))
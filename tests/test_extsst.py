@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""EXTSST written by the bundled xlwt, checked against the shared string
+table as decoded by xlrd."""
+import random
+import struct
+
+import pytest
+import xlrd
+import xlwt
+
+from biff import records, workbook_stream
+
+SST, CONTINUE, EXTSST = 0x00FC, 0x003C, 0x00FF
+
+
+def read_sst_string(stream, pos, sst_records):
+    """Decodes the string starting at stream position pos, following it
+    into the CONTINUE records that come after the one holding pos."""
+    recx = [k for k, (start, end) in enumerate(sst_records) if start <= pos < end][0]
+    nchars, flags = struct.unpack_from('<HB', stream, pos)
+    pos += 3
+    if flags & 0x08:
+        pos += 2
+    if flags & 0x04:
+        pos += 4
+    wide = flags & 0x01
+    chars = []
+    ndecoded = 0
+    while ndecoded < nchars:
+        end = sst_records[recx][1]
+        if pos == end:
+            # the characters go on in the next CONTINUE, after a new flags byte
+            recx += 1
+            pos = sst_records[recx][0]
+            wide = ord(stream[pos:pos + 1]) & 0x01
+            pos += 1
+            end = sst_records[recx][1]
+        size = wide and 2 or 1
+        n = min(nchars - ndecoded, (end - pos) // size)
+        assert n > 0, 'string at %d does not fit its records' % pos
+        chars.append(stream[pos:pos + n * size].decode(wide and 'utf-16-le' or 'latin-1'))
+        ndecoded += n
+        pos += n * size
+    return u''.join(chars)
+
+
+def check_extsst(path):
+    stream = workbook_stream(path)
+    recs = records(stream)
+    ids = [rid for pos, rid, data in recs]
+    sstx = ids.index(SST)
+    sst_records = []
+    for pos, rid, data in recs[sstx:]:
+        if rid not in (SST, CONTINUE) or (rid == SST and sst_records):
+            break
+        sst_records.append((pos + 4, pos + 4 + len(data)))
+    # EXTSST follows the last CONTINUE
+    pos, rid, data = recs[sstx + len(sst_records)]
+    assert rid == EXTSST
+    record_headers = set(start - 4 for start, end in sst_records)
+
+    strings = xlrd.open_workbook(path, on_demand=True)._sharedstrings
+    dsst, = struct.unpack_from('<H', data)
+    nbuckets = (len(data) - 2) // 8
+    assert dsst >= 8 and nbuckets <= 128
+    assert nbuckets == -(-len(strings) // dsst)
+    for k in range(nbuckets):
+        ib, cb_offset, reserved = struct.unpack_from('<IHH', data, 2 + 8 * k)
+        assert ib - cb_offset in record_headers
+        assert read_sst_string(stream, ib, sst_records) == strings[k * dsst]
+    return len(strings), nbuckets
+
+
+def random_strings(n, seed):
+    rnd = random.Random(seed)
+    for i in range(n):
+        kind = rnd.randrange(4)
+        if kind == 0:
+            yield u'v%d' % i
+        elif kind == 1:
+            yield u'\xe9%d' % i
+        elif kind == 2:
+            yield u'中%d' % i
+        else:
+            # long strings get split over CONTINUE records
+            yield u'long%d' % i + u'x' * rnd.randrange(9000)
+
+
+@pytest.mark.parametrize('nstrings', [0, 1, 7, 8, 9, 1000, 1024, 1025, 20000])
+@pytest.mark.parametrize('sst_memory_limit', [0, 64 * 1024], ids=['in_memory', 'spilled'])
+def test_extsst_buckets(tmp_path, nstrings, sst_memory_limit):
+    wb = xlwt.Workbook(encoding='utf-8', sst_memory_limit=sst_memory_limit)
+    ws = wb.add_sheet('a')
+    ws.write(0, 0, 1)
+    for i, s in enumerate(random_strings(nstrings, nstrings)):
+        ws.write(i // 200 + 1, i % 200, s)
+    if nstrings > 5:
+        ws.write_rich_text(nstrings // 200 + 2, 0, [u'rt', (u'rich', xlwt.XFStyle().font)])
+    path = str(tmp_path / 'extsst.xls')
+    wb.save(path)
+    count, nbuckets = check_extsst(path)
+    assert count == nstrings + (nstrings > 5)
@@ -0,0 +1,111 @@
+"""INDEX and DBCELL offsets written by the bundled xlwt, parsed back from
+the saved file and checked against the record positions."""
+import random
+import struct
+
+import pytest
+import xlrd
+import xlwt
+
+from biff import records, workbook_stream
+
+BOF, EOF, BOUNDSHEET, INDEX, DEFCOLWIDTH, ROW, DBCELL = 0x0809, 0x000A, 0x0085, 0x020B, 0x0055, 0x0208, 0x00D7
+CELL_RECORDS = frozenset([0x00FD, 0x0204, 0x0203, 0x027E, 0x00BD, 0x0201, 0x00BE, 0x0205, 0x0006])
+
+
+def check_index(path, nsheets):
+    """Follows every INDEX and DBCELL offset, returns {sheet index: rows}."""
+    recs = records(workbook_stream(path))
+    by_pos = dict((pos, (rid, data)) for pos, rid, data in recs)
+    following = dict((a[0], b[0]) for a, b in zip(recs, recs[1:]))
+    sheet_positions = [struct.unpack_from('<I', data)[0] for pos, rid, data in recs if rid == BOUNDSHEET]
+    assert len(sheet_positions) == nsheets
+    sheet_rows = {}
+    for sheetx, sheet_pos in enumerate(sheet_positions):
+        assert by_pos[sheet_pos][0] == BOF
+        index_pos = following[sheet_pos]
+        rid, data = by_pos[index_pos]
+        assert rid == INDEX
+        _, first_row, last_row, defcolwidth_pos = struct.unpack_from('<4I', data)
+        dbcell_positions = struct.unpack_from('<%dI' % ((len(data) - 16) // 4), data, 16)
+        assert by_pos[defcolwidth_pos][0] == DEFCOLWIDTH
+        rows = []
+        for dbcell_pos in dbcell_positions:
+            rid, data = by_pos[dbcell_pos]
+            assert rid == DBCELL
+            first_row_offset, = struct.unpack_from('<I', data)
+            cell_offsets = struct.unpack_from('<%dH' % ((len(data) - 4) // 2), data, 4)
+            # the DBCELL points back at the block's first ROW record
+            pos = dbcell_pos - first_row_offset
+            block_rows = []
+            for _ in cell_offsets:
+                rid, data = by_pos[pos]
+                assert rid == ROW
+                block_rows.append(struct.unpack_from('<H', data)[0])
+                pos = following[pos]
+            assert block_rows == sorted(block_rows)
+            assert len(set(rowx >> 5 for rowx in block_rows)) == 1
+            # the first offset leads from the second ROW to the first cell,
+            # the others from one row's first cell to the next row's
+            cell_pos = dbcell_pos - first_row_offset + 20 + cell_offsets[0]
+            assert cell_pos == pos
+            for k, rowx in enumerate(block_rows):
+                if k:
+                    cell_pos += cell_offsets[k]
+                rid, data = by_pos[cell_pos] if cell_pos != dbcell_pos else (DBCELL, b'')
+                if rid in CELL_RECORDS and struct.unpack_from('<H', data)[0] == rowx:
+                    continue
+                # a row without cells shares its position with the next row
+                assert k + 1 == len(block_rows) or cell_offsets[k + 1] == 0
+            rows.extend(block_rows)
+        assert len(rows) == len(set(rows))
+        if rows:
+            assert (first_row, last_row) == (min(rows), max(rows) + 1)
+        else:
+            assert (first_row, last_row) == (0, 0)
+        sheet_rows[sheetx] = rows
+    return sheet_rows
+
+
+@pytest.mark.parametrize('compact_rows', [False, True], ids=['plain', 'compact'])
+@pytest.mark.parametrize('flush_every', [0, 77, 1000], ids=['unflushed', 'flush77', 'flush1000'])
+def test_index_dbcell_offsets(tmp_path, compact_rows, flush_every):
+    rnd = random.Random(19)
+    wb = xlwt.Workbook(compact_rows=compact_rows)
+    xf, = wb.add_styles([xlwt.XFStyle()])
+    expected = []
+    for sheetx, nrows in enumerate([3000, 5, 0, 1500]):
+        ws = wb.add_sheet('s%d' % sheetx)
+        if sheetx == 3:
+            ws.set_inline_string_cols([1])
+        values = {}
+        rowx = 3 if sheetx == 1 else 0
+        for written in range(1, nrows + 1):
+            row = [float(rowx), 'v%d' % (rowx % 50), 'u%d' % rowx, '', round(rnd.random(), 2)]
+            if rowx % 41 == 0:
+                row[0] = True
+            ws.write_row(rowx, row, [xf] * len(row))
+            values[rowx] = row
+            # gaps between some rows, some blocks stay partly empty
+            rowx += 1 if rowx % 100 else 37
+            if flush_every and written % flush_every == 0:
+                ws.flush_row_data()
+        if sheetx == 3:
+            ws.write(rowx + 5, 0, 'x' * 300)
+            ws.row(rowx + 6)  # a row without cells
+            values[rowx + 5] = ['x' * 300]
+        expected.append(values)
+    path = str(tmp_path / 'index.xls')
+    wb.save(path)
+
+    sheet_rows = check_index(path, 4)
+    for sheetx, values in enumerate(expected):
+        assert set(values) <= set(sheet_rows[sheetx])
+
+    book = xlrd.open_workbook(path)
+    for sheetx, values in enumerate(expected):
+        sheet = book.sheet_by_index(sheetx)
+        for rowx, row in values.items():
+            for colx, value in enumerate(row):
+                if value != '':
+                    assert sheet.cell_value(rowx, colx) == value
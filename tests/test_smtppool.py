@@ -0,0 +1,191 @@
+"""smtppool.SMTPPool against a local SMTP stand-in that counts the
+connections it accepts."""
+import smtplib
+import socket
+import threading
+import time
+
+import pytest
+
+import smtppool
+
+MESSAGE = 'Subject: test\r\n\r\nhello\r\n'
+
+
+class CountingSMTPServer(object):
+    """Just enough SMTP for smtplib. Counts connections and messages,
+    refuses bad@ recipients and drops every connection after drop_after
+    messages if that is set."""
+
+    def __init__(self, drop_after=0):
+        self.drop_after = drop_after
+        self.connections = 0
+        self.messages = 0
+        self.lock = threading.Lock()
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.server = '127.0.0.1:%d' % self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except (socket.error, OSError):
+                return
+            with self.lock:
+                self.connections += 1
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        reader = conn.makefile('rb')
+
+        def reply(line):
+            conn.sendall(line.encode('ascii') + b'\r\n')
+
+        reply('220 stand-in ready')
+        sent = 0
+        try:
+            while True:
+                line = reader.readline()
+                if not line:
+                    break
+                command = line.decode('ascii', 'replace').strip().upper()
+                if command.startswith('EHLO'):
+                    reply('250-stand-in')
+                    reply('250 SIZE 10000000')
+                elif command.startswith(('HELO', 'NOOP', 'RSET', 'MAIL')):
+                    reply('250 ok')
+                elif command.startswith('RCPT'):
+                    reply('BAD@' in command and '550 no such user' or '250 ok')
+                elif command == 'DATA':
+                    reply('354 go ahead')
+                    line = reader.readline()
+                    while line not in (b'.\r\n', b''):
+                        line = reader.readline()
+                    if not line:
+                        break
+                    with self.lock:
+                        self.messages += 1
+                    reply('250 queued')
+                    sent += 1
+                    if self.drop_after and sent >= self.drop_after:
+                        break
+                elif command == 'QUIT':
+                    reply('221 bye')
+                    break
+                else:
+                    reply('500 unknown command')
+        finally:
+            conn.close()
+
+    def wait_for(self, messages):
+        # the server counts a message after replying to it
+        deadline = time.time() + 5
+        while self.messages < messages and time.time() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def server():
+    srv = CountingSMTPServer()
+    yield srv
+    srv.close()
+
+
+def send(pool, recipients=('a@example.com',)):
+    with pool.connection() as smtp:
+        return smtp.sendmail('me@example.com', list(recipients), MESSAGE)
+
+
+def test_connection_is_reused(server):
+    pool = smtppool.SMTPPool(server.server)
+    for i in range(20):
+        send(pool)
+    pool.close()
+    server.wait_for(20)
+    assert (server.connections, server.messages) == (1, 20)
+    assert (pool.connects, pool.reuses) == (1, 19)
+
+
+def test_idle_timeout_zero_connects_per_message(server):
+    pool = smtppool.SMTPPool(server.server, idle_timeout=0)
+    for i in range(5):
+        send(pool)
+    assert server.connections == 5
+
+
+def test_expired_connection_is_replaced(server):
+    pool = smtppool.SMTPPool(server.server, idle_timeout=0.2)
+    send(pool)
+    send(pool)
+    time.sleep(0.3)
+    send(pool)
+    pool.close()
+    assert server.connections == 2
+
+
+def test_dropped_connection_is_replaced():
+    srv = CountingSMTPServer(drop_after=3)
+    try:
+        pool = smtppool.SMTPPool(srv.server)
+        for i in range(9):
+            send(pool)
+        pool.close()
+        srv.wait_for(9)
+        assert (srv.connections, srv.messages) == (3, 9)
+    finally:
+        srv.close()
+
+
+def test_refused_recipients_keep_the_connection(server):
+    pool = smtppool.SMTPPool(server.server)
+    assert send(pool, ['a@example.com', 'bad@example.com']) == {'bad@example.com': (550, b'no such user')}
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        send(pool, ['bad@example.com'])
+    send(pool)
+    assert server.connections == 1
+
+
+def test_error_during_data_discards_the_connection(server):
+    pool = smtppool.SMTPPool(server.server)
+    with pytest.raises(IOError):
+        with pool.connection() as smtp:
+            smtp.mail('me@example.com')
+            smtp.rcpt('a@example.com')
+            smtp.putcmd('data')
+            smtp.getreply()
+            # the server now waits for the rest of the message
+            raise IOError('attachment could not be read')
+    send(pool)
+    pool.close()
+    server.wait_for(1)
+    assert (server.connections, server.messages) == (2, 1)
+
+
+def test_threads_share_the_pool(server):
+    pool = smtppool.SMTPPool(server.server)
+    threads = [threading.Thread(target=lambda: [send(pool) for i in range(10)]) for j in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pool.close()
+    server.wait_for(40)
+    assert server.messages == 40
+    assert server.connections <= 4
+
+
+def test_get_pool_shares_pools_per_server_and_credentials():
+    pool = smtppool.get_pool('mail.example.com:25', False, True, 'user', 'secret')
+    assert smtppool.get_pool('mail.example.com:25', False, True, 'user', 'secret') is pool
+    assert smtppool.get_pool('mail.example.com:25') is not pool